@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+TCP 建连后端基准（本地监听，无需联网）
+- 子进程在若干本地端口上 accept 后立即关闭
+- 依次用 SCAN_BACKENDS 中的每个后端（以及已安装时的 uvloop）发起 N 次建连
+- 输出每个组合的 connects/s 与失败数
+
+用法：python bench/bench_backends.py [次数] [并发]
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import selectors
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import generate as g  # noqa: E402
+
+LISTEN_PORTS = 8
+
+
+def acceptor(socks, ready):
+    sel = selectors.DefaultSelector()
+    for s in socks:
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ)
+    ready.set()
+    while True:
+        for key, _ in sel.select():
+            try:
+                while True:
+                    conn, _ = key.fileobj.accept()
+                    conn.close()
+            except (BlockingIOError, InterruptedError):
+                pass
+
+
+async def run(backend: str, ports, total: int, concurrency: int):
+    sem = asyncio.Semaphore(concurrency)
+    fails = 0
+
+    async def one(i):
+        nonlocal fails
+        async with sem:
+            d, _ = await g.tcp_connect("127.0.0.1", ports[i % len(ports)], 2.0, backend)
+            if d < 0:
+                fails += 1
+
+    t = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return time.perf_counter() - t, fails
+
+
+def loops():
+    yield "asyncio", asyncio.new_event_loop
+    try:
+        import uvloop
+        yield "uvloop", uvloop.new_event_loop
+    except ImportError:
+        pass
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    socks = []
+    for _ in range(LISTEN_PORTS):
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        s.listen(4096)
+        socks.append(s)
+    ports = [s.getsockname()[1] for s in socks]
+    ready = multiprocessing.Event()
+    proc = multiprocessing.Process(target=acceptor, args=(socks, ready), daemon=True)
+    proc.start()
+    ready.wait()
+    print(f"{total} 次建连，并发 {concurrency}，监听端口 {len(ports)} 个")
+    print(f"{'loop':<8} {'backend':<8} {'秒':>8} {'connects/s':>12} {'失败':>6}")
+    try:
+        for loop_name, factory in loops():
+            for backend in g.SCAN_BACKENDS:
+                loop = factory()
+                try:
+                    secs, fails = loop.run_until_complete(run(backend, ports, total, concurrency))
+                finally:
+                    loop.close()
+                print(f"{loop_name:<8} {backend:<8} {secs:>8.2f} {total / secs:>12.0f} {fails:>6}")
+    finally:
+        proc.terminate()
+
+
+if __name__ == "__main__":
+    main()
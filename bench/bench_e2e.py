@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+离线端到端基准：合成订阅源 + 本地假代理，完整跑一遍 generate.main()
+- 本地 HTTP 服务器提供 collect 支持的全部格式：Base64 订阅、Clash YAML、README 混排文本、IP:PORT 列表
+- 子进程内的本地监听端口扮演：存活(仅 TCP)、拒绝(死)、慢速、SOCKS5 / SOCKS4 / HTTP CONNECT 代理、普通 Web 前端
+- 节点地址分布在 127.0.0.0/8 上，保证 (type, server, port) 各不相同
+- 输出各阶段耗时、调用次数、峰值 RSS 与吞吐；--json 另存机器可读结果
+
+用法：python bench/bench_e2e.py [--scales 1000,10000] [--keep-top 200] [--json out.json]
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+import functools
+import threading
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 端口角色 → 在 IP:PORT / 协议链接中出现的权重
+ROLES = ("live", "dead", "slow", "socks5", "socks4", "http", "web")
+IPPORT_MIX = {"dead": 5, "web": 2, "socks5": 1, "socks4": 1, "http": 1, "slow": 1}
+PROTO_MIX = {"dead": 6, "live": 3, "slow": 1}
+
+# 计时的阶段函数（main() 通过模块全局调用，替换模块属性即可插桩）
+STAGES = ("run_pipeline", "resample_top", "app_probe_all", "verify_all",
+          "export_whole_proto", "export_batches", "export_single_fast_nodes", "export_top5_bundle",
+          "write_yaml", "save_qr_to", "build_index_html")
+
+
+# ===================== 本地假代理 / 监听端口 =====================
+async def _http_reply(reader, writer):
+    await asyncio.wait_for(reader.read(4096), timeout=5)
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+    await writer.drain()
+
+
+async def _socks5(reader, writer):
+    head = await reader.readexactly(2)
+    await reader.readexactly(head[1])
+    writer.write(b"\x05\x00")
+    await writer.drain()
+    req = await reader.readexactly(4)
+    if req[3] == 1:
+        await reader.readexactly(6)
+    elif req[3] == 4:
+        await reader.readexactly(18)
+    else:
+        await reader.readexactly((await reader.readexactly(1))[0] + 2)
+    writer.write(b"\x05\x00\x00\x01" + b"\x00" * 6)
+    await writer.drain()
+    await _http_reply(reader, writer)
+
+
+async def _socks4(reader, writer):
+    req = await reader.readexactly(8)
+    await reader.readuntil(b"\x00")
+    if req[4:7] == b"\x00\x00\x00" and req[7] != 0:
+        await reader.readuntil(b"\x00")
+    writer.write(b"\x00\x5a" + b"\x00" * 6)
+    await writer.drain()
+    await _http_reply(reader, writer)
+
+
+async def _http_proxy(reader, writer):
+    head = await reader.readuntil(b"\r\n\r\n")
+    if not head.startswith(b"CONNECT"):
+        writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+        return
+    writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+    await writer.drain()
+    await _http_reply(reader, writer)
+
+
+async def _web(reader, writer):
+    await reader.read(1024)
+    writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+
+
+async def _slow(reader, writer):
+    await asyncio.sleep(0.5)
+    await _socks5(reader, writer)
+
+
+HANDLERS = {"socks5": _socks5, "socks4": _socks4, "http": _http_proxy, "web": _web, "slow": _slow}
+
+
+def _serve(role):
+    handler = HANDLERS.get(role)
+
+    async def on_conn(reader, writer):
+        try:
+            if handler:
+                await asyncio.wait_for(handler(reader, writer), timeout=10)
+        except Exception:
+            pass
+        finally:
+            writer.close()
+    return on_conn
+
+
+def listeners_main(socks_by_role, ready):
+    async def run():
+        for role, s in socks_by_role.items():
+            if role != "dead":
+                await asyncio.start_server(_serve(role), sock=s, backlog=4096)
+        ready.set()
+        await asyncio.Event().wait()
+    asyncio.run(run())
+
+
+def start_listeners():
+    socks_by_role, ports = {}, {}
+    for role in ROLES:
+        s = socket.socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(("0.0.0.0", 0))        # 0.0.0.0 才能接收 127.x.y.z 上的连接
+        ports[role] = s.getsockname()[1]
+        if role == "dead":
+            s.close()                  # 端口已释放 → 连接被拒绝
+        else:
+            s.listen(4096)
+            socks_by_role[role] = s
+    ready = multiprocessing.Event()
+    proc = multiprocessing.Process(target=listeners_main, args=(socks_by_role, ready), daemon=True)
+    proc.start()
+    ready.wait()
+    return proc, ports
+
+
+# ===================== 合成订阅源 =====================
+def loop_ip(i: int) -> str:
+    a = i // 254
+    return f"127.{1 + a // 256}.{a % 256}.{i % 254 + 1}"
+
+
+def pick(rnd: random.Random, mix: dict) -> str:
+    return rnd.choices(list(mix), weights=list(mix.values()))[0]
+
+
+def proto_link(k: int, host: str, port: int, i: int) -> str:
+    if k == 0:
+        raw = f"aes-256-gcm:pw{i}@{host}:{port}"
+        return "ss://" + base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=") + f"#n{i}"
+    if k == 1:
+        raw = f"{host}:{port}:origin:aes-256-cfb:plain:{base64.urlsafe_b64encode(b'pw').decode()}/?r=1"
+        return "ssr://" + base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+    if k == 2:
+        js = {"v": "2", "ps": f"vm{i}", "add": host, "port": str(port), "id": "%032x" % i,
+              "aid": "0", "net": "tcp", "tls": ""}
+        return "vmess://" + base64.b64encode(json.dumps(js).encode()).decode()
+    if k == 3:
+        return f"trojan://pw{i}@{host}:{port}#t{i}"
+    return f"vless://{'%032x' % i}@{host}:{port}?type=tcp"
+
+
+def build_sources(n: int, ports: dict, seed: int = 7) -> dict:
+    """约 40% 协议链接（Base64 订阅）、10% Clash YAML、10% README 混排、40% IP:PORT 列表"""
+    rnd = random.Random(seed)
+    idx = iter(range(10 ** 9))
+    sub, readme, ipport, yaml_lines = [], [], [], ["proxies:"]
+    for _ in range(int(n * 0.4)):
+        i = next(idx)
+        sub.append(proto_link(i % 5, loop_ip(i), ports[pick(rnd, PROTO_MIX)], i))
+    for _ in range(int(n * 0.1)):
+        i = next(idx)
+        readme.append(f"| {i} | 节点 `{proto_link(i % 5, loop_ip(i), ports[pick(rnd, PROTO_MIX)], i)}` | 今日更新 |")
+        readme.append("这是一段无关的说明文字，包含 http://example.com/ 链接与 1.2.3 版本号。")
+    for _ in range(int(n * 0.1)):
+        i = next(idx)
+        yaml_lines.append(f"  - {{name: y{i}, type: ss, server: {loop_ip(i)}, port: {ports[pick(rnd, PROTO_MIX)]}, "
+                          f"cipher: aes-128-gcm, password: p{i}}}")
+    for _ in range(int(n * 0.4)):
+        i = next(idx)
+        ipport.append(f"{loop_ip(i)}:{ports[pick(rnd, IPPORT_MIX)]}")
+    return {
+        "/sub": base64.b64encode("\n".join(sub).encode()).decode().encode(),
+        "/README.md": "\n".join(readme).encode(),
+        "/clash.yaml": "\n".join(yaml_lines).encode(),
+        "/SOCKS5.txt": "\n".join(ipport).encode(),
+    }
+
+
+def start_http(bodies: dict):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = bodies.get(self.path)
+            self.send_response(200 if body is not None else 404)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body or b"")))
+            self.end_headers()
+            self.wfile.write(body or b"")
+
+        def log_message(self, *args):
+            pass
+
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+# ===================== 阶段插桩 =====================
+def instrument(g, timings: dict):
+    def wrap(name, fn):
+        rec = timings.setdefault(name, {"seconds": 0.0, "calls": 0})
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def aw(*a, **k):
+                t = time.perf_counter()
+                try:
+                    return await fn(*a, **k)
+                finally:
+                    rec["seconds"] += time.perf_counter() - t
+                    rec["calls"] += 1
+            return aw
+
+        @functools.wraps(fn)
+        def w(*a, **k):
+            t = time.perf_counter()
+            try:
+                return fn(*a, **k)
+            finally:
+                rec["seconds"] += time.perf_counter() - t
+                rec["calls"] += 1
+        return w
+
+    for name in STAGES:
+        setattr(g, name, wrap(name, getattr(g, name)))
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_scale(n: int, args) -> dict:
+    """在独立子进程中运行，保证每个规模的峰值 RSS 与模块状态互不影响"""
+    workdir = tempfile.mkdtemp(prefix=f"bench_e2e_{n}_")
+    os.chdir(workdir)
+    os.environ["CACHE_DIR"] = os.path.join(workdir, ".cache")
+    sys.path.insert(0, REPO_DIR)
+    import generate as g
+
+    proc, ports = start_listeners()
+    srv = start_http(build_sources(n, ports))
+    base = f"http://127.0.0.1:{srv.server_address[1]}"
+    g.SOURCES = [base + p for p in ("/sub", "/README.md", "/clash.yaml", "/SOCKS5.txt")]
+    g.VERIFY_TARGET = ("127.0.0.1", srv.server_address[1])
+    g.HEALTH_ENABLED = False
+    g.KEEP_TOP_PER_TYPE = args.keep_top
+    timings: dict = {}
+    instrument(g, timings)
+    rss0 = peak_rss_mb()
+    t = time.perf_counter()
+    try:
+        g.main()
+    finally:
+        total = time.perf_counter() - t
+        srv.shutdown()
+        proc.terminate()
+    return {
+        "scale": n,
+        "total_seconds": round(total, 3),
+        "candidates_per_second": round(n / timings["run_pipeline"]["seconds"], 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "rss_at_start_mb": round(rss0, 1),
+        "stages": {k: {"seconds": round(v["seconds"], 3), "calls": v["calls"]} for k, v in timings.items()},
+        "workdir": workdir,
+    }
+
+
+def _child(n, args, q):
+    import contextlib
+    import io
+    buf = io.StringIO()
+    with contextlib.redirect_stdout(buf if not args.verbose else sys.stdout):
+        res = run_scale(n, args)
+    q.put(res)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="generate.py 离线端到端基准")
+    ap.add_argument("--scales", default="1000,10000", help="候选节点规模，逗号分隔（如 1000,10000,100000）")
+    ap.add_argument("--keep-top", type=int, default=2000, help="覆盖 KEEP_TOP_PER_TYPE")
+    ap.add_argument("--json", help="结果另存为 JSON")
+    ap.add_argument("--verbose", action="store_true", help="显示 generate.py 自身输出")
+    args = ap.parse_args()
+
+    results = []
+    for n in (int(x) for x in args.scales.split(",")):
+        q = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_child, args=(n, args, q))
+        p.start()
+        res = q.get()
+        p.join()
+        results.append(res)
+        print(f"\n== {n} 候选：总耗时 {res['total_seconds']}s，流水线吞吐 {res['candidates_per_second']}/s，"
+              f"峰值 RSS {res['peak_rss_mb']}MB")
+        for name, st in sorted(res["stages"].items(), key=lambda kv: -kv[1]["seconds"]):
+            if st["calls"]:
+                print(f"   {name:<26} {st['seconds']:>9.3f}s  ×{st['calls']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+候选节点内存基准：dict 节点 + 元组去重键（旧表示） vs Node（__slots__ + 压缩 IPv4）+ 整数去重键
+- 合成 N 个候选：约 70% IP:PORT 列表行，其余为 ss / vmess / trojan 链接
+- 两种表示各自解析同一文本：计时一遍，再用 tracemalloc 统计保留下来的 (节点列表, seen) 占用
+- 另测“测速循环式”按键访问与写 YAML 前转换为 Clash dict 的耗时
+
+用法：python bench/bench_memory.py [N ...]
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import base64
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import generate as g  # noqa: E402
+
+
+def synth_text(n: int, seed: int = 3) -> str:
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(n):
+        host = f"{rnd.randint(1,223)}.{rnd.randint(0,255)}.{rnd.randint(0,255)}.{rnd.randint(1,254)}"
+        k = rnd.random()
+        if k < 0.7:
+            lines.append(f"{host}:{rnd.randint(1000,65000)}")
+        elif k < 0.8:
+            raw = f"aes-256-gcm:pw{i}@{host}:{rnd.randint(1000,65000)}"
+            lines.append("ss://" + base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=") + f"#n{i}")
+        elif k < 0.9:
+            js = {"v": "2", "ps": f"n{i}", "add": host, "port": "443", "id": "%032x" % rnd.getrandbits(128),
+                  "aid": "0", "net": "ws", "path": "/ws", "host": "", "tls": "tls"}
+            lines.append("vmess://" + base64.b64encode(json.dumps(js).encode()).decode())
+        else:
+            lines.append(f"trojan://pw{i}@{host}:443#t{i}")
+    return "\n".join(lines)
+
+
+def legacy_parse(text: str, seen: set):
+    """旧表示：解析结果原样保留为 dict，去重键为 (type, server, port) 元组，端点候选也是 dict"""
+    nodes = []
+    for p in g.parse_tokens(list(g.scan_proto_links(text))):
+        if p:
+            key = (p["type"], p["server"], p["port"])
+            if key not in seen:
+                seen.add(key); nodes.append(p)
+    for host, port in g.extract_ipports(text):
+        protos = [proto for proto in g.IPPORT_PROTOS if (proto, host, port) not in seen]
+        if not protos:
+            continue
+        seen.update((proto, host, port) for proto in protos)
+        nodes.append({"name": f"EP_{host}_{port}", "type": "endpoint", "server": host, "port": port,
+                      "sniff": protos})
+    return nodes
+
+
+def compact_parse(text: str, seen: set):
+    return g.parse_source("bench", text, seen)
+
+
+def measure(fn, text: str):
+    """先不开 tracemalloc 计时（其分配钩子会放大耗时），再单独跑一遍统计保留内存"""
+    gc.collect()
+    t = time.perf_counter()
+    fn(text, set())
+    secs = time.perf_counter() - t
+    gc.collect()
+    tracemalloc.start()
+    seen: set = set()
+    nodes = fn(text, seen)
+    gc.collect()
+    cur, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return nodes, seen, cur, secs
+
+
+def access_loop(nodes):
+    """模拟测速循环：读 server / port / type，写 delay，再读 delay 排序"""
+    t = time.perf_counter()
+    for n in nodes:
+        _ = (n["server"], n["port"], n.get("type"))
+        n["delay"] = 1.0
+    sum(n.get("delay", 9e9) for n in nodes)
+    return time.perf_counter() - t
+
+
+def export_time(nodes):
+    t = time.perf_counter()
+    g.to_clash_proxies(nodes)
+    return time.perf_counter() - t
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 100000, 300000]
+    g.CDN_POLICY = "off"   # legacy_parse 没有 CDN 网段合并，关掉它两种表示才是同一批节点
+    print(f"{'N':>8} {'repr':<8} {'nodes':>8} {'MB':>8} {'B/cand':>8} {'parse(s)':>9} {'access(s)':>10} {'to_clash(s)':>12}")
+    for n in sizes:
+        text = synth_text(n)
+        for name, fn in (("dict", legacy_parse), ("Node", compact_parse)):
+            nodes, seen, cur, secs = measure(fn, text)
+            acc = access_loop(nodes)
+            exp = export_time(nodes)
+            print(f"{n:>8} {name:<8} {len(nodes):>8} {cur / 2**20:>8.1f} {cur / max(1, len(nodes)):>8.0f} "
+                  f"{secs:>9.2f} {acc:>10.3f} {exp:>12.3f}")
+            del nodes, seen
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+内嵌二维码分批基准：固定 BATCH_SIZE 切片（旧） vs 按二维码容量装箱（pack_links）
+- 节点取自 docs/<协议>.yaml（存在时），另加合成的 socks5 / vmess 大列表
+- 统计批次数、可内嵌批次数、被拒（降级 URL 型）批次数、内嵌组平均装满率
+- 旧方式对每批都编码 data: URI 再判断；两种方式都实际渲染可内嵌的二维码并核对 QR 版本不超出预期
+
+用法：python bench/bench_qr_pack.py [合成节点数]
+"""
+
+import os
+import sys
+import time
+import base64
+import random
+
+import yaml
+import qrcode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import generate as g  # noqa: E402
+
+
+def docs_nodes():
+    for proto in g.EXPORT_PROTOS:
+        path = os.path.join(g.DOCS_DIR, f"{proto}.yaml")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                nodes = (yaml.safe_load(f) or {}).get("proxies") or []
+        except OSError:
+            continue
+        if nodes:
+            yield f"docs/{proto}", nodes
+
+
+def synth_nodes(n: int, seed: int = 5):
+    rnd = random.Random(seed)
+    host = lambda: f"{rnd.randint(1,223)}.{rnd.randint(0,255)}.{rnd.randint(0,255)}.{rnd.randint(1,254)}"
+    yield "synth/socks5", [g.ipport_node("socks5", host(), rnd.randint(1000, 65000)) for _ in range(n)]
+    yield "synth/vmess", [{"name": f"n{i}", "type": "vmess", "server": host(), "port": 443,
+                           "uuid": "%032x" % rnd.getrandbits(128), "alterId": 0, "cipher": "auto",
+                           "network": "ws", "ws-opts": {"path": "/ws"}, "tls": True} for i in range(n // 4)]
+
+
+def qr_version(data: str) -> int:
+    qr = qrcode.QRCode(version=None, error_correction=qrcode.constants.ERROR_CORRECT_M)
+    qr.add_data(data)
+    qr.make(fit=True)
+    return qr.version
+
+
+def legacy(nodes):
+    """旧方式：固定切片，编码后再判断是否超出 EMBED_MAX_BYTES"""
+    out = []
+    for i in range(0, len(nodes), g.BATCH_SIZE):
+        txt = g.build_pure_link_list(nodes[i:i+g.BATCH_SIZE])
+        uri = g.DATA_URI_PREFIX + base64.b64encode(txt.encode()).decode()
+        out.append(uri if txt.strip() and len(uri) <= g.EMBED_MAX_BYTES else None)
+    return out
+
+
+def packed(nodes):
+    bins, rest = g.pack_links(nodes, g.embed_raw_budget())
+    out = []
+    for b in bins:
+        txt = g.build_pure_link_list(b)
+        out.append(g.DATA_URI_PREFIX + base64.b64encode(txt.encode()).decode())
+    out += [None] * ((len(rest) + g.BATCH_SIZE - 1) // g.BATCH_SIZE)
+    return out
+
+
+def render(uris, budget):
+    t = time.perf_counter()
+    bad = 0
+    for u in uris:
+        if u is not None:
+            g.make_qr_img(u)
+            bad += qr_version(u) > g.qr_version_for(budget)
+    return time.perf_counter() - t, bad
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    budget = g.embed_budget()
+    print(f"内嵌上限 {budget} 字节（QR 版本 {g.qr_version_for(budget)}，M 级），固定切片 BATCH_SIZE={g.BATCH_SIZE}")
+    print(f"{'set':<14} {'nodes':>6} {'mode':<7} {'batches':>8} {'embed':>6} {'reject':>7} {'fill':>6} "
+          f"{'render(s)':>10} {'over':>5}")
+    for name, nodes in list(docs_nodes()) + list(synth_nodes(n)):
+        for mode, fn in (("legacy", legacy), ("packed", packed)):
+            uris = fn(nodes)
+            emb = [u for u in uris if u is not None]
+            fill = sum(len(u) for u in emb) / (len(emb) * budget) if emb else 0.0
+            secs, over = render(uris, budget)
+            print(f"{name:<14} {len(nodes):>6} {mode:<7} {len(uris):>8} {len(emb):>6} {len(uris) - len(emb):>7} "
+                  f"{fill:>6.1%} {secs:>10.2f} {over:>5}")
+
+
+if __name__ == "__main__":
+    main()
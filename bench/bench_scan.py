@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+协议链接扫描微基准
+- 合成多 MB 的聚合订阅文本（ss / ssr / vmess / trojan / vless / README 混排）
+- 对比旧版“六次 findall + dict.fromkeys”与 scan_proto_links() 单次扫描
+- 分别统计纯扫描耗时与“扫描 + parse_*”总耗时
+
+用法：python bench/bench_scan.py [MB ...]
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import generate as g  # noqa: E402
+
+
+def legacy_extract(text: str):
+    out = []
+    out += g.SS_RE.findall(text)
+    out += g.SSR_RE.findall(text)
+    out += g.SIP002_RE.findall(text)
+    out += g.VMESS_RE.findall(text)
+    out += g.TROJAN_RE.findall(text)
+    out += g.VLESS_RE.findall(text)
+    return list(dict.fromkeys(out))
+
+
+def legacy_parse(text: str):
+    res = []
+    for lk in legacy_extract(text):
+        p = None
+        if lk.startswith("ss://"): p = g.parse_ss(lk)
+        elif lk.startswith("ssr://"): p = g.parse_ssr(lk)
+        elif lk.startswith("sip002://"): p = g.parse_sip002(lk)
+        elif lk.startswith("vmess://"): p = g.parse_vmess(lk)
+        elif lk.startswith("trojan://"): p = g.parse_trojan(lk)
+        elif lk.startswith("vless://"): p = g.parse_vless(lk)
+        if p:
+            res.append(p)
+    return res
+
+
+def scan_parse(text: str):
+    res = []
+    for scheme, lk in g.scan_proto_links(text):
+        p = g.PROTO_PARSERS[scheme](lk)
+        if p:
+            res.append(p)
+    return res
+
+
+def synth_line(i: int, rnd: random.Random) -> str:
+    host = f"{rnd.randint(1,223)}.{rnd.randint(0,255)}.{rnd.randint(0,255)}.{rnd.randint(1,254)}"
+    k = i % 6
+    if k == 0:
+        raw = f"aes-256-gcm:pw{i}@{host}:{rnd.randint(1000,65000)}"
+        return "ss://" + base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=") + f"#node{i}"
+    if k == 1:
+        js = {"v": "2", "ps": f"n{i}", "add": host, "port": "443", "id": "%032x" % rnd.getrandbits(128),
+              "aid": "0", "net": "ws", "path": "/ws", "host": "", "tls": "tls"}
+        return "vmess://" + base64.b64encode(json.dumps(js).encode()).decode()
+    if k == 2:
+        return f"trojan://pw{i}@{host}:443#t{i}"
+    if k == 3:
+        return f"vless://{'%032x' % rnd.getrandbits(128)}@{host}:443?security=tls&type=ws"
+    if k == 4:
+        raw = f"{host}:8443:origin:aes-256-cfb:plain:{base64.urlsafe_b64encode(b'pw').decode()}/?remarks=x"
+        return "ssr://" + base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+    return f"| {i} | server {host}:1080 | 更新于今天 |"
+
+
+def synth_body(mb: float, seed: int = 1) -> str:
+    rnd = random.Random(seed)
+    lines, size, i = [], 0, 0
+    while size < mb * 1_000_000:
+        ln = synth_line(i, rnd)
+        lines.append(ln)
+        size += len(ln) + 1
+        i += 1
+    return "\n".join(lines)
+
+
+def timeit(fn, arg, repeat=3):
+    best, res = 9e9, None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        res = fn(arg)
+        best = min(best, time.perf_counter() - t)
+    return best, res
+
+
+def main():
+    sizes = [float(a) for a in sys.argv[1:]] or [1, 4, 16]
+    print(f"{'MB':>6} {'stage':<14} {'legacy(ms)':>11} {'scan(ms)':>10} {'speedup':>8} {'links':>14}")
+    for mb in sizes:
+        text = synth_body(mb)
+        t_old, old = timeit(legacy_extract, text)
+        t_new, new = timeit(lambda t: list(g.scan_proto_links(t)), text)
+        print(f"{mb:>6g} {'extract':<14} {t_old*1e3:>11.1f} {t_new*1e3:>10.1f} {t_old/t_new:>7.2f}x "
+              f"{len(old):>6}/{len(new):<7}")
+        t_old, old = timeit(legacy_parse, text, repeat=1)
+        t_new, new = timeit(scan_parse, text, repeat=1)
+        print(f"{mb:>6g} {'extract+parse':<14} {t_old*1e3:>11.1f} {t_new*1e3:>10.1f} {t_old/t_new:>7.2f}x "
+              f"{len(old):>6}/{len(new):<7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,33 +14,125 @@
 import os
 import re
 import sys
+import errno
 import json
 import time
+import random
 import base64
 import socket
+import struct
+import signal
+import ssl
+import hashlib
+import zlib
+import array
+import bisect
+import gzip
+import ipaddress
 import asyncio
+import heapq
 import datetime
+import itertools
+import threading
+import collections
+import collections.abc
+import argparse
 import traceback
 import contextlib
-from typing import List, Dict, Tuple
+import concurrent.futures
+import multiprocessing
+from typing import List, Dict, Tuple, Optional
+from urllib.parse import urlsplit, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 import requests
 import yaml
 import qrcode
 from PIL import Image, ImageDraw
-import socks  # PySocks
 
 # ===================== 可调参数 =====================
-TIMEOUT_TCP = 2.0            # TCP 测速超时(秒)
-CONCURRENCY = 400            # 并发数量
+TIMEOUT_TCP = 2.0            # TCP 测速超时(秒)，自适应超时的上限
+ADAPTIVE_TIMEOUT = True      # 按本次运行已观测到的延迟分布收紧超时
+ADAPT_TIMEOUT_QUANTILE = 0.95  # 取成功样本的该分位数
+ADAPT_TIMEOUT_FACTOR = 1.5   # 超时 = 分位数 × 系数（夹在 [ADAPT_TIMEOUT_MIN, TIMEOUT_TCP]）
+ADAPT_TIMEOUT_MIN = 0.3      # 自适应超时下限(秒)
+ADAPT_MIN_SAMPLES = 200      # 至少观测到这么多成功样本才开始自适应
+SAMPLE_COUNT = 5             # 多次采样：每个候选共测几次 TCP 建连（1 = 关闭）
+SAMPLE_TOP_PER_TYPE = 50     # 仅对每协议前 N 名做多次采样，控制测速预算
+DELAY_STAT = "median"        # 多次采样后 delay 字段取值："min" | "median" | "p90"
+CONCURRENCY = 400            # 并发数量（自适应时为起始值）
+SCAN_BACKEND = "raw" if os.name == "posix" else "stream"  # TCP 测速后端："stream"=open_connection，"sock"=loop.sock_connect，"raw"=connect_ex + add_writer
+USE_UVLOOP = True            # 已安装 uvloop 时使用其事件循环
+ADAPTIVE_CONCURRENCY = True  # TCP 测速并发按 AIMD 自适应（依据错误率 / 超时率 / 延迟膨胀）
+CONCURRENCY_MIN = 32         # 自适应并发下限
+CONCURRENCY_MAX = 4000       # 自适应并发上限（另受 RLIMIT_NOFILE 约束）
+ADAPT_WINDOW = 200           # 每完成多少个探测评估一次
+ADAPT_STEP = 50              # 加性增量
+ADAPT_INFLATION = 2.0        # 窗口中位延迟超过基线该倍数视为拥塞
+FD_RESERVE = 128             # 预留给抓取/日志等的文件描述符
+PROBE_SHARDS = 1             # 本机分片测速的进程数（按 (server, port) 哈希分片，各自独立事件循环与并发预算；1 = 单进程）
 SOCKS_GOOGLE_TIMEOUT = 4.0   # SOCKS/HTTP 代理连 Google 超时
+VERIFY_TARGET = ("www.google.com", 443)  # 严格验证：经代理隧道访问的目标；443 时在隧道内做 TLS 握手（SNI + 校验证书），其他端口发 HEAD（可指向本地替身服务器测试）
+DNS_BACKEND = "system"       # 域名解析后端："system"=getaddrinfo（专用线程池），"udp"=直接向 DNS_SERVER 查询 A 记录
+DNS_SERVER = ("1.1.1.1", 53) # udp 后端使用的 DNS 服务器（测试时可指向本地桩服务器）
+DNS_WORKERS = 64             # system 后端的解析线程数（不占用默认线程池）
+DNS_TIMEOUT = 3.0            # 单次解析超时(秒)
+SNIFF_TIMEOUT = 3.0          # IP:PORT 协议嗅探：握手应答等待超时(秒)
+SNIFF_TARGET = ("1.1.1.1", 443)  # SOCKS4 / HTTP CONNECT 嗅探时请求的目标（IP，免代理端 DNS；443：多数 HTTP 代理默认拒绝 CONNECT 其他端口）
 KEEP_TOP_PER_TYPE = 2000     # 每协议最多保留
+APP_PROBE = True             # 对 TCP 可用的 trojan/vless/vmess 追加 TLS 握手（+ ws 升级）测速
+APP_PROBE_TIMEOUT = 4.0      # 应用层测速超时(秒)
+RANK_KEY = "delay"           # 排序依据："delay"=TCP 建连，"_tls_ms"=TLS 握手，"_app_ms"=建连+TLS+ws 全程
 STRICT_CN_GOOGLE = True      # 生成 proxy_cn_google.yaml（仅 SOCKS/HTTP 代理内连通 Google）
-BATCH_SIZE = 20              # 每批节点数（二维码分批）
-EMBED_MAX_BYTES = 1800       # 内嵌二维码最大 data: 内容字节数（超过则自动降级为 URL 型）
+BATCH_SIZE = 20              # 无法内嵌的节点（单条链接超出容量 / 无链接）每批节点数；可内嵌的按二维码容量装箱
+EMBED_MAX_BYTES = 1800       # 内嵌二维码最大 data: 内容字节数（向上取到所落 QR 版本的满容量；超过则降级为 URL 型）
 QR_SIZE = 660                # 生成二维码图像像素
 QR_BORDER = 24               # 外围彩色圆角边框宽度（像素）
 
+FETCH_TIMEOUT = 12.0         # 单个订阅源抓取超时(秒)
+FETCH_DEADLINE = 120.0       # 抓取阶段总时限(秒)，超时未完成的源直接放弃
+FETCH_WORKERS = 16           # 并发抓取线程数
+FETCH_PER_HOST = 6           # 每主机并发上限（同主机共享 keep-alive 连接池）
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", "1"))  # 解析进程数：1=串行，0=按 CPU 核数（命令行 --parse-workers 覆盖）
+PARSE_CHUNK = 2000           # 进程池解析时每块链接数
+PARSE_PARALLEL_MIN = 5000    # 单个源链接数达到该值才启用进程池（小源串行更快）
+HTTP_CACHE_MAX_STALE = 3 * 86400  # 源失败时允许使用的缓存最大陈旧度(秒)，0 = 不回退
+
+HEALTH_ENABLED = True        # 跨运行节点健康库：连续失败的节点按指数退避跳过测速
+HEALTH_BACKOFF_BASE = 20 * 3600   # 连续失败 1 次后的退避(秒)，每多失败一次翻倍（略小于日更间隔）
+HEALTH_BACKOFF_MAX = 14 * 86400   # 退避上限(秒)
+HEALTH_REVIVE_SAMPLE = 0.05  # 退避期内仍抽样复测的比例（发现“复活”节点）
+HEALTH_EXPIRE = 30 * 86400   # 记录超过该时长未在任何源中出现则清理(秒)
+HEALTH_KEEP_DELAYS = 5       # 每节点保留最近几次延迟
+
+CDN_POLICY = "collapse"      # IP:PORT 候选落在 CDN/anycast 网段时："skip"=丢弃，"collapse"=每个 (网段, 端口) 只留一个，"tag"=保留并标记 _cdn，"off"=不分类
+CDN_RANGES_FILE = os.environ.get("CDN_RANGES", "cdn_ranges.txt")  # 追加网段（每行 "CIDR [标签]"，# 注释；不存在则只用内置 Cloudflare 列表）
+
+DAEMON_SOURCE_INTERVAL = 1800     # 守护模式：源刷新基础间隔(秒)，内容未变则间隔翻倍
+DAEMON_SOURCE_MAX = 6 * 3600      # 源刷新最大间隔(秒)
+DAEMON_PROBE_TOP = 120            # 排行第 1 名的复测间隔(秒)，名次越靠后间隔越长
+DAEMON_PROBE_TAIL = 1800          # 排行末位（及未入榜的存活节点）的复测间隔(秒)
+DAEMON_PROBE_MAX = 6 * 3600       # 失败节点指数退避上限(秒)；已展开的端点按此间隔重新嗅探
+DAEMON_EVICT_FAILS = 8            # 连续失败达到该次数移出内存（源中仍有时会被重新加入）
+DAEMON_PUBLISH_CHECK = 60         # 每隔多少秒检查一次排行变化
+DAEMON_REPUBLISH_DELTA = 0.10     # 某协议 Top-K 成员变化（Jaccard 距离）达到该值、或前 5 名变化时重写该协议导出
+DAEMON_REPUBLISH_MAX = 3600       # 至少每隔多少秒全量重写一次（刷新延迟数值）
+DAEMON_INFLIGHT = 4 * CONCURRENCY  # 同时挂起的复测任务上限（实际并发仍由 AdaptiveLimiter 控制）
+
+SERVE_ADDR = "127.0.0.1:8080"     # --serve 默认监听地址
+SERVE_CACHE_SIZE = 256            # 订阅服务：渲染结果 LRU 条数
+SERVE_GZIP_MIN = 512              # 响应体不小于该字节数时预先生成 gzip 版本
+SERVE_MAX_AGE = 60                # Cache-Control: max-age(秒)
+EXPORT_BATCHES = True             # 写出每协议分批 YAML + 二维码；由订阅服务按需切片时可关闭
+DELTA_ENABLED = True              # 写 manifest.json + 增量文件（相对上一版本新增 / 删除 / 变化的节点）
+DELTA_KEEP = 48                   # manifest 中保留的增量个数；落后更多版本的客户端回退全量下载
+DELTA_IGNORE = ("delay",)         # 判断节点“变化”时忽略的字段（每次测速都会变）
+COMPRESS_FILES = ("proxy.yaml", "proxy_all.yaml", "sub")  # 预压缩的大文件：同目录写 .gz（及已安装 brotli 时的 .br）
+COMPRESS_MIN = 1024               # 小于该字节数的文件（含增量）不写压缩版本
+
+STATS_ENABLED = True         # 分阶段统计：写 docs/stats.json（耗时 / 条数 / 字节 / 错误分类 / 峰值内存）
+PROM_TEXTFILE = os.environ.get("PROM_TEXTFILE", "")  # 非空时另写 Prometheus textfile（供 node_exporter textfile collector）
+
 TOPN_SINGLE_NODE_QR = 3      # 每协议“单节点二维码”（紫）数量
 SINGLE_QR_COLOR = (168, 85, 247)  # 紫色：单节点二维码边框颜色
 
@@ -96,15 +188,22 @@ SITE_BASE = f"https://{OWNER}.github.io/{REPO_NAME}"
 RAW_BASE  = f"https://raw.githubusercontent.com/{OWNER}/{REPO_NAME}/main/docs"
 
 DOCS_DIR   = "docs"
+CACHE_DIR  = os.environ.get("CACHE_DIR", ".cache")   # 运行间持久化（Actions 中由 actions/cache 保存）
+HTTP_CACHE_DIR = os.path.join(CACHE_DIR, "http")
+HEALTH_PATH = os.path.join(CACHE_DIR, "health.json")
+STATS_PATH = os.path.join(DOCS_DIR, "stats.json")
 QRS_DIR    = os.path.join(DOCS_DIR, "qrs")
 GROUPS_DIR = os.path.join(DOCS_DIR, "groups")
 SINGLES_DIR= os.path.join(DOCS_DIR, "singles")
 YELLOW_DIR = os.path.join(DOCS_DIR, "top5")
+DELTA_DIR  = os.path.join(DOCS_DIR, "delta")
+MANIFEST_PATH = os.path.join(DOCS_DIR, "manifest.json")
 os.makedirs(DOCS_DIR, exist_ok=True)
 os.makedirs(QRS_DIR, exist_ok=True)
 os.makedirs(GROUPS_DIR, exist_ok=True)
 os.makedirs(SINGLES_DIR, exist_ok=True)
 os.makedirs(YELLOW_DIR, exist_ok=True)
+os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
 
 # ===================== 工具函数 =====================
 def b64pad(s: str) -> str:
@@ -122,14 +221,265 @@ def now_str_beijing():
         .astimezone(datetime.timezone(datetime.timedelta(hours=8)))\
         .strftime("%Y-%m-%d %H:%M:%S %Z%z")
 
-def fetch_text(url: str, timeout=12) -> str:
+# ===================== 分阶段统计 =====================
+def peak_rss_bytes() -> int:
+    """进程至今的峰值常驻内存（字节）；非 POSIX 平台返回 0"""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024   # Linux 单位为 KB
+
+class StageStats:
+    """
+    线程安全的分阶段计量：抓取/解析在线程池、测速在事件循环中并发记录。
+    每阶段：calls、seconds（各次调用耗时之和）、wall（首次开始到最后结束）、
+    items / bytes 等计数、errors（按错误类别计数）、rss_peak（阶段结束时的进程峰值 RSS）。
+    """
+    def __init__(self):
+        self.started = time.time()
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self.stages: Dict[str, Dict] = {}
+
+    def _get(self, name: str) -> Dict:
+        s = self.stages.get(name)
+        if s is None:
+            s = self.stages[name] = {"calls": 0, "seconds": 0.0, "first": None, "last": 0.0,
+                                     "counts": collections.Counter(), "errors": collections.Counter(),
+                                     "rss_peak": 0}
+        return s
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error(name, type(e).__name__)
+            raise
+        finally:
+            end = time.perf_counter()
+            rss = peak_rss_bytes()
+            with self._lock:
+                s = self._get(name)
+                s["calls"] += 1
+                s["seconds"] += end - start
+                s["first"] = start if s["first"] is None else min(s["first"], start)
+                s["last"] = max(s["last"], end)
+                s["rss_peak"] = max(s["rss_peak"], rss)
+
+    def add(self, name: str, **counts):
+        with self._lock:
+            self._get(name)["counts"].update(counts)
+
+    def error(self, name: str, cls: str, n: int = 1):
+        with self._lock:
+            self._get(name)["errors"][cls] += n
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            stages = {}
+            for name, s in self.stages.items():
+                wall = (s["last"] - s["first"]) if s["first"] is not None else 0.0
+                stages[name] = {"calls": s["calls"], "seconds": round(s["seconds"], 3),
+                                "wall": round(wall, 3), **dict(s["counts"]),
+                                "errors": dict(s["errors"]), "rss_peak_mb": round(s["rss_peak"] / 2**20, 1)}
+        return {"started": datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).isoformat(),
+                "seconds": round(time.perf_counter() - self._t0, 3),
+                "rss_peak_mb": round(peak_rss_bytes() / 2**20, 1),
+                "stages": stages}
+
+    def prometheus(self, prefix: str = "proxygen") -> str:
+        """Prometheus 文本格式（gauge）；计数项统一为 {prefix}_stage_count{stage,kind}"""
+        snap = self.snapshot()
+        rows = [
+            ("run_seconds", "整次运行耗时", [("", snap["seconds"])]),
+            ("run_timestamp_seconds", "本次运行开始时间", [("", round(self.started, 3))]),
+            ("run_rss_peak_bytes", "进程峰值 RSS", [("", peak_rss_bytes())]),
+        ]
+        per = {"stage_seconds": ("各次调用耗时之和", []), "stage_wall_seconds": ("首次开始到最后结束", []),
+               "stage_calls": ("调用次数", []), "stage_count": ("条数 / 字节等计数", []),
+               "stage_errors": ("按类别的错误数", []), "stage_rss_peak_bytes": ("阶段结束时的峰值 RSS", [])}
+        for name, st in snap["stages"].items():
+            lbl = f'stage="{name}"'
+            per["stage_seconds"][1].append((lbl, st["seconds"]))
+            per["stage_wall_seconds"][1].append((lbl, st["wall"]))
+            per["stage_calls"][1].append((lbl, st["calls"]))
+            per["stage_rss_peak_bytes"][1].append((lbl, int(st["rss_peak_mb"] * 2**20)))
+            for k, v in st.items():
+                if k not in ("calls", "seconds", "wall", "errors", "rss_peak_mb"):
+                    per["stage_count"][1].append((f'{lbl},kind="{k}"', v))
+            for cls, v in st["errors"].items():
+                per["stage_errors"][1].append((f'{lbl},class="{cls}"', v))
+        rows += [(k, h, vals) for k, (h, vals) in per.items()]
+        out = []
+        for metric, help_, vals in rows:
+            out.append(f"# HELP {prefix}_{metric} {help_}")
+            out.append(f"# TYPE {prefix}_{metric} gauge")
+            out += [f"{prefix}_{metric}{{{lbl}}} {v}" if lbl else f"{prefix}_{metric} {v}" for lbl, v in vals]
+        return "\n".join(out) + "\n"
+
+STATS = StageStats()
+RUN_REPORT: Dict = {}        # 本次运行的结构化报告（各阶段写入），与 STATS 一并写入 stats.json
+
+def write_run_report(path: str = STATS_PATH, prom_path: str = PROM_TEXTFILE):
+    """RUN_REPORT（各阶段写入的明细）+ 分阶段统计 → stats.json；可选 Prometheus textfile（原子替换）"""
+    report = dict(RUN_REPORT)
+    report.update(STATS.snapshot())
+    write_text(path, json.dumps(report, ensure_ascii=False, indent=2, default=str))
+    if prom_path:
+        tmp = prom_path + ".tmp"
+        write_text(tmp, STATS.prometheus())
+        os.replace(tmp, prom_path)
+
+# ===================== 并发抓取（连接池 + 每主机限流 + 总时限） =====================
+_HOST_SEMS: Dict[str, threading.BoundedSemaphore] = {}
+_HOST_SEMS_LOCK = threading.Lock()
+
+def _host_sem(host: str) -> threading.BoundedSemaphore:
+    with _HOST_SEMS_LOCK:
+        if host not in _HOST_SEMS:
+            _HOST_SEMS[host] = threading.BoundedSemaphore(FETCH_PER_HOST)
+        return _HOST_SEMS[host]
+
+def make_session() -> requests.Session:
+    """同一 Session 内按主机复用连接；raw.githubusercontent.com 上的源共享同一连接池"""
+    s = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=FETCH_PER_HOST)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    s.headers["User-Agent"] = "Mozilla/5.0"
+    return s
+
+# —— 磁盘条件请求缓存：按 URL 保存 body + ETag/Last-Modified，304 复用，失败时回退陈旧副本 ——
+def _http_cache_path(url: str) -> str:
+    return os.path.join(HTTP_CACHE_DIR, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+def http_cache_load(url: str):
     try:
-        r = requests.get(url, timeout=timeout, headers={"User-Agent": "Mozilla/5.0"})
-        if r.status_code == 200:
-            return r.text
+        with open(_http_cache_path(url), "r", encoding="utf-8") as f:
+            entry = json.load(f)
+        return entry if entry.get("url") == url else None
+    except Exception:
+        return None
+
+def http_cache_store(url: str, entry: Dict):
+    path = _http_cache_path(url)
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
     except Exception:
         pass
-    return ""
+
+def _stale_fallback(url: str, stat: Dict) -> str:
+    entry = http_cache_load(url)
+    if not entry or HTTP_CACHE_MAX_STALE <= 0:
+        return ""
+    if time.time() - entry.get("validated_at", 0) > HTTP_CACHE_MAX_STALE:
+        return ""
+    stat["cache"] = "stale"
+    return entry.get("body", "")
+
+def fetch_source(session: requests.Session, url: str, deadline: float) -> Tuple[str, Dict]:
+    """抓取单个源，返回 (文本, 统计)；统计含 status / bytes / ms / cache / error"""
+    with STATS.stage("fetch"):
+        text, stat = _fetch_source(session, url, deadline)
+    STATS.add("fetch", items=1, bytes=stat["bytes"])
+    if stat["cache"]:
+        STATS.add("fetch", **{f"cache_{stat['cache']}": 1})
+    if stat["error"] or stat["status"] not in (0, 200, 304):
+        STATS.error("fetch", stat["error"] or f"http_{stat['status']}")
+    return text, stat
+
+def _fetch_source(session: requests.Session, url: str, deadline: float) -> Tuple[str, Dict]:
+    host = urlsplit(url).hostname or ""
+    stat = {"url": url, "host": host, "status": 0, "bytes": 0, "ms": 0.0, "cache": "", "error": ""}
+    start = time.perf_counter()
+    sem = _host_sem(host)
+    if not sem.acquire(timeout=max(0.0, deadline - time.monotonic())):
+        stat["error"] = "deadline"
+        return _stale_fallback(url, stat), stat
+    try:
+        remain = deadline - time.monotonic()
+        if remain <= 0:
+            stat["error"] = "deadline"
+            return _stale_fallback(url, stat), stat
+        entry = http_cache_load(url)
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        r = session.get(url, timeout=min(FETCH_TIMEOUT, remain), stream=True, headers=headers)
+        stat["status"] = r.status_code
+        if r.status_code == 304 and entry:
+            r.close()
+            entry["validated_at"] = time.time()
+            http_cache_store(url, entry)
+            stat["cache"] = "304"
+            return entry.get("body", ""), stat
+        if r.status_code != 200:
+            r.close()
+            return _stale_fallback(url, stat), stat
+        chunks = []
+        for chunk in r.iter_content(65536):
+            chunks.append(chunk)
+            if time.monotonic() > deadline:
+                r.close()
+                stat["error"] = "deadline"
+                return _stale_fallback(url, stat), stat
+        body = b"".join(chunks)
+        stat["bytes"] = len(body)
+        text = body.decode(r.encoding or "utf-8", "ignore")
+        if r.headers.get("ETag") or r.headers.get("Last-Modified") or HTTP_CACHE_MAX_STALE > 0:
+            http_cache_store(url, {
+                "url": url,
+                "etag": r.headers.get("ETag", ""),
+                "last_modified": r.headers.get("Last-Modified", ""),
+                "validated_at": time.time(),
+                "body": text,
+            })
+        return text, stat
+    except Exception as e:
+        stat["error"] = type(e).__name__
+        return _stale_fallback(url, stat), stat
+    finally:
+        sem.release()
+        stat["ms"] = round((time.perf_counter() - start) * 1000.0, 1)
+
+def fetch_all(urls: List[str]) -> Tuple[List[str], List[Dict]]:
+    """并发抓取全部源；返回值与 urls 一一对应（顺序不变），未完成/失败的为空串（或缓存副本）"""
+    deadline = time.monotonic() + FETCH_DEADLINE
+    texts = [""] * len(urls)
+    report = [{"url": u, "host": urlsplit(u).hostname or "", "status": 0, "bytes": 0,
+               "ms": 0.0, "cache": "", "error": "deadline"} for u in urls]
+    session = make_session()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+    try:
+        futs = {pool.submit(fetch_source, session, u, deadline): i for i, u in enumerate(urls)}
+        done, _ = concurrent.futures.wait(futs, timeout=max(0.0, deadline - time.monotonic()))
+        for fut in done:
+            i = futs[fut]
+            texts[i], report[i] = fut.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    for i, u in enumerate(urls):
+        if report[i]["error"] == "deadline" and not texts[i]:
+            texts[i] = _stale_fallback(u, report[i])
+    return texts, report
+
+def print_fetch_report(report: List[Dict]):
+    for st in report:
+        flag = st["error"] or st["status"]
+        print(f"[Fetch] {flag!s:>8} {st['cache']:>5} {st['bytes']:>9}B {st['ms']:>8.1f}ms  {st['url']}")
+    ok = sum(1 for st in report if st["bytes"] or st["cache"])
+    total = sum(st["bytes"] for st in report)
+    cached = sum(1 for st in report if st["cache"])
+    print(f"[Fetch] 成功 {ok}/{len(report)}（缓存 {cached}），下载 {total} 字节")
 
 # —— QR：带彩色圆角边框（URL=蓝色、内嵌=绿色、单节点=紫色、Top5=黄色） ——
 def _rounded_rect(img: Image.Image, radius: int, border_px: int, color: tuple):
@@ -152,24 +502,71 @@ def make_qr_img(data: str, border_color=(52,104,255)) -> Image.Image:
     img = img.resize((QR_SIZE, QR_SIZE), Image.NEAREST)
     return _rounded_rect(img, radius=36, border_px=QR_BORDER, color=border_color)
 
+# QR 各版本（1~40）在纠错级别 M、8bit 字节模式下的最大字节数（与 make_qr_img 的 ERROR_CORRECT_M 对应）
+QR_BYTE_CAPACITY_M = (
+    14, 26, 42, 62, 84, 106, 122, 152, 180, 213, 251, 287, 331, 362, 412, 450, 504, 560, 624, 666,
+    711, 779, 857, 911, 997, 1059, 1125, 1190, 1264, 1370, 1452, 1538, 1628, 1722, 1809, 1911, 1989, 2099, 2213, 2331,
+)
+DATA_URI_PREFIX = "data:text/plain;base64,"
+
+def qr_version_for(nbytes: int) -> Optional[int]:
+    """容纳 nbytes 字节所需的最小 QR 版本（M 级），超出版本 40 返回 None"""
+    i = bisect.bisect_left(QR_BYTE_CAPACITY_M, nbytes)
+    return i + 1 if i < len(QR_BYTE_CAPACITY_M) else None
+
+def embed_budget() -> int:
+    """内嵌二维码 data: URI 的字节上限：EMBED_MAX_BYTES 所落版本的满容量（同一版本模块数不变，装满不增加扫码难度）"""
+    v = qr_version_for(EMBED_MAX_BYTES)
+    return QR_BYTE_CAPACITY_M[v - 1] if v else QR_BYTE_CAPACITY_M[-1]
+
+def data_uri_len(raw_len: int) -> int:
+    """raw_len 字节的文本编码成 data:text/plain;base64 URI 后的长度（不必真的编码）"""
+    return len(DATA_URI_PREFIX) + 4 * ((raw_len + 2) // 3)
+
+def embed_raw_budget() -> int:
+    """内嵌二维码可容纳的纯链接列表原文字节数"""
+    return (embed_budget() - len(DATA_URI_PREFIX)) // 4 * 3
+
+_QR_RENDERED: Dict[str, str] = {}   # 路径 → 内容摘要：同一进程内内容未变的二维码不重复渲染（守护模式增量导出）
+
 def save_qr_to(path: str, data: str, color: tuple):
-    img = make_qr_img(data, border_color=color)
-    img.save(path, format="PNG", optimize=True)
+    sig = hashlib.blake2b(f"{color}|{data}".encode("utf-8"), digest_size=16).hexdigest()
+    if _QR_RENDERED.get(path) == sig and os.path.exists(path):
+        STATS.add("qr", skipped=1)
+        return
+    _QR_RENDERED.pop(path, None)
+    with STATS.stage("qr"):
+        img = make_qr_img(data, border_color=color)
+        img.save(path, format="PNG", optimize=True)
+    _QR_RENDERED[path] = sig
+    STATS.add("qr", items=1, bytes=len(data))
 
 def write_text(path: str, s: str):
     with open(path, "w", encoding="utf-8") as f:
         f.write(s)
 
-def write_yaml(path: str, proxies: List[Dict]):
+def write_yaml(path: str, nodes: List[Dict]):
+    """节点在此才转成 Clash dict（去掉内部字段）"""
+    proxies = to_clash_proxies(nodes)
     data = {"proxies": proxies}
-    with open(path, "w", encoding="utf-8") as f:
+    with STATS.stage("yaml"), open(path, "w", encoding="utf-8") as f:
         yaml.safe_dump(data, f, allow_unicode=True, sort_keys=False)
+        STATS.add("yaml", items=len(proxies), bytes=f.tell())
 
 def write_base64_sub(path: str, yaml_bytes: bytes):
     b64 = base64.b64encode(yaml_bytes).decode("utf-8")
     with open(path, "w", encoding="utf-8") as f:
         f.write(b64)
 
+def quantile(sorted_vals: List[float], q: float) -> float:
+    """线性插值分位数，sorted_vals 需已升序"""
+    if not sorted_vals:
+        return 0.0
+    pos = (len(sorted_vals) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (pos - lo)
+
 def avg_delay(ms_list: List[float]) -> float:
     return round(sum(ms_list)/len(ms_list), 1) if ms_list else 0.0
 
@@ -178,8 +575,13 @@ SS_RE     = re.compile(r"(ss://[A-Za-z0-9+/=_\-:%#@.]+)", re.IGNORECASE)
 SSR_RE    = re.compile(r"(ssr://[A-Za-z0-9+/=_\-:;]+)", re.IGNORECASE)
 SIP002_RE = re.compile(r"(sip002://[A-Za-z0-9+/=_\-:%#@.]+)", re.IGNORECASE)
 VMESS_RE  = re.compile(r"(vmess://[A-Za-z0-9+/=_\-:;{}\",.]+)", re.IGNORECASE)
-TROJAN_RE = re.compile(r"(trojan://[A-Za-z0-9+/=_\-:%#@.]+)", re.IGNORECASE)
+TROJAN_RE = re.compile(r"(trojan://[A-Za-z0-9+/=_\-:%#@.?&=]+)", re.IGNORECASE)
 VLESS_RE  = re.compile(r"(vless://[A-Za-z0-9+/=_\-:%#@.?&=]+)", re.IGNORECASE)
+# 单次扫描：六种协议合并为一个带命名分组的交替式，lastgroup 即协议名
+PROTO_SCHEMES = ("ss", "ssr", "sip002", "vmess", "trojan", "vless")
+PROTO_RE  = re.compile("|".join(
+    f"(?P<{k}>{rx.pattern})" for k, rx in
+    zip(PROTO_SCHEMES, (SS_RE, SSR_RE, SIP002_RE, VMESS_RE, TROJAN_RE, VLESS_RE))), re.IGNORECASE)
 IPPORT_RE = re.compile(r"\b((\d{1,3}\.){3}\d{1,3}):(\d{2,5})\b")
 
 # ===================== 解析器 =====================
@@ -285,23 +687,24 @@ def parse_vmess(link: str):
             "cipher": "auto",
             "tls": bool(js.get("tls")) or js.get("tls") == "tls",
             "network": js.get("net") or "tcp",
-            "ws-opts": {"path": js.get("path", "/"), "headers": {"Host": js.get("host", "")}}
+            "ws-opts": {"path": js.get("path", "/"), "headers": {"Host": js.get("host", "")}},
+            **({"servername": js["sni"]} if js.get("sni") else {})
         }
     except:
         return None
 
 def parse_trojan(link: str):
+    """trojan://password@host:port?sni=&type=&path=&host=#备注 → Clash trojan 条目"""
     try:
         if not link.startswith("trojan://"):
             return None
-        rest = link[9:]
-        password, addr = rest.split("@",1)
-        addr = addr.split("#")[0]
-        host, port = addr.split(":")
-        port_i = safe_int(port)
-        if not port_i:
+        u = urlsplit(link)
+        password = u.netloc.rpartition("@")[0]     # 密码里可能带 ':'，不用 u.username
+        host, port_i = u.hostname, u.port
+        if not password or not host or not port_i:
             return None
-        return {
+        q = {k: v[-1] for k, v in parse_qs(u.query).items()}
+        node = {
             "name": f"Trojan_{host}_{port_i}",
             "type": "trojan",
             "server": host,
@@ -309,44 +712,115 @@ def parse_trojan(link: str):
             "password": password,
             "udp": True
         }
+        if q.get("sni") or q.get("peer"):
+            node["sni"] = q.get("sni") or q["peer"]
+        net = (q.get("type") or "").lower()
+        if net:
+            node["network"] = net
+        if net == "ws":
+            ws = {"path": q.get("path") or "/"}
+            if q.get("host"):
+                ws["headers"] = {"Host": q["host"]}
+            node["ws-opts"] = ws
+        elif net == "grpc" and q.get("serviceName"):
+            node["grpc-opts"] = {"grpc-service-name": q["serviceName"]}
+        return node
     except:
         return None
 
 def parse_vless(link: str):
+    """vless://uuid@host:port?security=&sni=&type=&path=&host=&flow=&pbk=&sid=&fp=#备注 → Clash vless 条目"""
     try:
         if not link.startswith("vless://"):
             return None
-        temp = link[8:]
-        if "@" not in temp or ":" not in temp:
-            return None
-        uuid, addr = temp.split("@",1)
-        host_port = addr.split("?",1)[0]
-        host, port = host_port.split(":")
-        port_i = safe_int(port)
-        if not port_i:
+        u = urlsplit(link)
+        host, port_i, uuid = u.hostname, u.port, u.username
+        if not host or not port_i or not uuid:
             return None
-        return {
+        q = {k: v[-1] for k, v in parse_qs(u.query).items()}
+        security = (q.get("security") or "none").lower()
+        net = (q.get("type") or "tcp").lower()
+        node = {
             "name": f"VLESS_{host}_{port_i}",
             "type": "vless",
             "server": host,
             "port": port_i,
             "uuid": uuid,
-            "tls": True,
-            "flow": "",
+            "tls": security in ("tls", "reality", "xtls"),
+            "network": net,
+            "flow": q.get("flow", ""),
             "udp": True
         }
+        if q.get("sni"):
+            node["servername"] = q["sni"]
+        if q.get("fp"):
+            node["client-fingerprint"] = q["fp"]
+        if security == "reality":
+            node["reality-opts"] = {"public-key": q.get("pbk", ""), "short-id": q.get("sid", "")}
+        if net == "ws":
+            ws = {"path": q.get("path") or "/"}
+            if q.get("host"):
+                ws["headers"] = {"Host": q["host"]}
+            node["ws-opts"] = ws
+        elif net == "grpc" and q.get("serviceName"):
+            node["grpc-opts"] = {"grpc-service-name": q["serviceName"]}
+        return node
     except:
         return None
 
-def extract_proto_links(text: str) -> List[str]:
-    out = []
-    out += SS_RE.findall(text)
-    out += SSR_RE.findall(text)
-    out += SIP002_RE.findall(text)
-    out += VMESS_RE.findall(text)
-    out += TROJAN_RE.findall(text)
-    out += VLESS_RE.findall(text)
-    return list(dict.fromkeys(out))
+PROTO_PARSERS = {
+    "ss": parse_ss,
+    "ssr": parse_ssr,
+    "sip002": parse_sip002,
+    "vmess": parse_vmess,
+    "trojan": parse_trojan,
+    "vless": parse_vless,
+}
+
+def scan_proto_links(text: str):
+    """单次遍历文本，按出现顺序产出去重后的 (scheme, link)；vless:// 内部不再被误识别为 ss://"""
+    seen = set()
+    for m in PROTO_RE.finditer(text):
+        lk = m.group()
+        if lk not in seen:
+            seen.add(lk)
+            yield m.lastgroup, lk
+
+# —— 可选进程池解析：按块分发 base64/JSON 解码，pool.map 保序，合并结果与串行完全一致 ——
+_PARSE_POOL = None
+
+def _parse_chunk(tokens: List[Tuple[str, str]]) -> List:
+    return [PROTO_PARSERS[scheme](lk) for scheme, lk in tokens]
+
+def _parse_pool():
+    global _PARSE_POOL
+    if _PARSE_POOL is None:
+        # 首次使用时抓取 / 解析线程已在运行，fork 多线程进程不安全，改用 spawn 启动
+        workers = PARSE_WORKERS or os.cpu_count() or 1
+        _PARSE_POOL = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                             mp_context=multiprocessing.get_context("spawn"))
+    return _PARSE_POOL
+
+def shutdown_parse_pool():
+    global _PARSE_POOL
+    if _PARSE_POOL is not None:
+        _PARSE_POOL.shutdown(wait=True)
+        _PARSE_POOL = None
+
+def parse_tokens(tokens: List[Tuple[str, str]]) -> List:
+    """解析 (scheme, link) 列表，返回与输入一一对应的结果（解析失败为 None）"""
+    if PARSE_WORKERS == 1 or len(tokens) < PARSE_PARALLEL_MIN:
+        return _parse_chunk(tokens)
+    chunks = [tokens[i:i+PARSE_CHUNK] for i in range(0, len(tokens), PARSE_CHUNK)]
+    try:
+        out = []
+        for res in _parse_pool().map(_parse_chunk, chunks):
+            out += res
+        return out
+    except Exception as e:
+        print(f"[Parse] 进程池解析失败，回退串行：{e}")
+        shutdown_parse_pool()
+        return _parse_chunk(tokens)
 
 def extract_ipports(text: str) -> List[Tuple[str, int]]:
     ips = []
@@ -380,16 +854,34 @@ def to_proto_link(n: Dict) -> str:
                 "type": "none",
                 "host": n.get("ws-opts",{}).get("headers",{}).get("Host",""),
                 "path": n.get("ws-opts",{}).get("path","/"),
-                "tls": "tls" if n.get("tls") else ""
+                "tls": "tls" if n.get("tls") else "",
+                "sni": n.get("servername") or ""
             }
             data = base64.b64encode(json.dumps(js, ensure_ascii=False).encode()).decode()
             return "vmess://" + data
         elif t == "trojan":
             pwd = n.get("password") or ""
-            return f"trojan://{pwd}@{host}:{port}"
+            ws = n.get("ws-opts") or {}
+            q = {"sni": n.get("sni"), "type": n.get("network"), "path": ws.get("path"),
+                 "host": (ws.get("headers") or {}).get("Host"),
+                 "serviceName": (n.get("grpc-opts") or {}).get("grpc-service-name")}
+            query = urlencode({k: v for k, v in q.items() if v})
+            server = f"[{host}]" if ":" in str(host) else host
+            return f"trojan://{pwd}@{server}:{port}" + (f"?{query}" if query else "")
         elif t == "vless":
             uuid = n.get("uuid") or ""
-            return f"vless://{uuid}@{host}:{port}"
+            reality = n.get("reality-opts")
+            ws = n.get("ws-opts") or {}
+            q = {"security": "reality" if reality else ("tls" if n.get("tls") else "none"),
+                 "type": n.get("network") or "tcp", "sni": n.get("servername"), "flow": n.get("flow"),
+                 "fp": n.get("client-fingerprint"), "path": ws.get("path"),
+                 "host": (ws.get("headers") or {}).get("Host"),
+                 "serviceName": (n.get("grpc-opts") or {}).get("grpc-service-name")}
+            if reality:
+                q.update(pbk=reality.get("public-key"), sid=reality.get("short-id"))
+            query = urlencode({k: v for k, v in q.items() if v})
+            server = f"[{host}]" if ":" in str(host) else host
+            return f"vless://{uuid}@{server}:{port}?{query}"
         elif t in ("socks5","socks4"):
             return f"{t}://{host}:{port}"
         elif t == "http":
@@ -398,35 +890,335 @@ def to_proto_link(n: Dict) -> str:
         return ""
     return ""
 
-# ===================== 抓取与初步解析 =====================
-def collect_nodes() -> List[Dict]:
-    nodes, seen = [], set()
-    for url in SOURCES:
-        print(f"[Fetch] {url}")
-        text = fetch_text(url)
-        if not text:
-            continue
+IPPORT_PROTOS = ("socks5", "socks4", "http")
+
+# ===================== 紧凑节点表示（__slots__ + 压缩 IPv4 + 驻留字符串） =====================
+INTERN_FIELDS = frozenset(("cipher", "network", "protocol", "obfs", "security", "flow"))
+
+def pack_ipv4(host) -> Optional[int]:
+    """点分十进制 IPv4 → uint32；非规范写法（前导零、简写等）返回 None，保证可原样还原"""
+    if not isinstance(host, str) or host.count(".") != 3:
+        return None
+    try:
+        packed = socket.inet_aton(host)
+    except OSError:
+        return None
+    return int.from_bytes(packed, "big") if socket.inet_ntoa(packed) == host else None
+
+def unpack_ipv4(ip: int) -> str:
+    return socket.inet_ntoa(struct.pack("!I", ip))
+
+_TYPE_IDS: Dict[str, int] = {}
+
+def node_keys(types, server, port, ip: Optional[int] = None) -> List:
+    """
+    去重键：IPv4 + 合法端口压成一个 int（type 序号 | IPv4 | 端口），其余退回 (type, server, port) 元组。
+    同一地址的多个 type 只解析一次地址；已知压缩 IPv4 时可经 ip 传入。
+    """
+    ip = pack_ipv4(server) if ip is None else ip
+    p = port if isinstance(port, int) else safe_int(port)
+    if ip is None or p is None or not 0 <= p < 65536:
+        return [(t, server, port) for t in types]
+    addr = (ip << 16) | p
+    keys = []
+    for t in types:
+        tid = _TYPE_IDS.get(t)
+        if tid is None:
+            tid = _TYPE_IDS[t] = len(_TYPE_IDS)
+        keys.append((tid << 48) | addr)
+    return keys
+
+def node_key(t: str, server, port):
+    return node_keys((t,), server, port)[0]
+
+class Node(collections.abc.MutableMapping):
+    """
+    紧凑节点：type / server / port / delay / sniff 存于 __slots__（IPv4 压成 int，type 与常见枚举值驻留），
+    其余字段放 extra（没有则为 None）。IP:PORT 节点与端点候选的 name / udp 按需生成，不占存储。
+    实现 dict 接口，按键读写的现有代码无需改动；写 YAML / 快照时再转为普通 dict（to_clash / to_dict）。
+    迭代顺序：name、type、server、port、(udp)、(sniff)、其余字段、delay、以 _ 开头的内部字段。
+    """
+    __slots__ = ("type", "_ip", "_host", "port", "delay", "sniff", "extra", "kind")
+    PLAIN, IPPORT, ENDPOINT = 0, 1, 2     # kind：普通 / IP:PORT 展开节点（自动 name + udp=False）/ 端点候选（自动 name）
+
+    def __init__(self, type_: str, server, port, kind: int = PLAIN, sniff=None, extra: Dict = None,
+                 ip: Optional[int] = None):
+        self.type = sys.intern(type_) if isinstance(type_, str) else type_
+        if ip is None:
+            self.server = server
+        else:
+            self._ip, self._host = ip, None
+        self.port = port
+        self.delay = None
+        self.sniff = sniff
+        self.extra = extra
+        self.kind = kind
+
+    @property
+    def server(self):
+        return unpack_ipv4(self._ip) if self._ip is not None else self._host
+
+    @server.setter
+    def server(self, host):
+        self._ip = pack_ipv4(host)
+        self._host = None if self._ip is not None else host
+
+    def _auto_name(self) -> str:
+        prefix = "EP" if self.kind == Node.ENDPOINT else str(self.type).upper()
+        return f"{prefix}_{self.server}_{self.port}"
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "Node":
+        t = d.get("type"); host = d.get("server"); port = d.get("port")
+        n = cls(t, host, port, sniff=d.get("sniff"))
+        if t == "endpoint":
+            n.kind = Node.ENDPOINT
+        elif t in IPPORT_PROTOS and d.get("udp") is False:
+            n.kind = Node.IPPORT
+        for k, v in d.items():
+            if k in ("type", "server", "port", "sniff"):
+                continue
+            if n.kind and ((k == "name" and v == n._auto_name()) or (k == "udp" and v is False)):
+                continue
+            n[k] = v
+        return n
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        if key == "type":
+            return self.type
+        if key == "server":
+            return self.server
+        if key == "port":
+            return self.port
+        if key == "delay":
+            if self.delay is None:
+                raise KeyError(key)
+            return self.delay
+        if key == "sniff" and self.sniff is not None:
+            return self.sniff
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        if self.kind:
+            if key == "name":
+                return self._auto_name()
+            if key == "udp" and self.kind == Node.IPPORT:
+                return False
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == "type":
+            self.type = sys.intern(value) if isinstance(value, str) else value
+        elif key == "server":
+            self.server = value
+        elif key == "port":
+            self.port = value
+        elif key == "delay":
+            self.delay = value
+        elif key == "sniff":
+            self.sniff = value
+        else:
+            if self.extra is None:
+                self.extra = {}
+            if key in INTERN_FIELDS and isinstance(value, str):
+                value = sys.intern(value)
+            self.extra[sys.intern(key)] = value
+
+    def __delitem__(self, key):
+        if key == "delay" and self.delay is not None:
+            self.delay = None
+        elif key == "sniff" and self.sniff is not None:
+            self.sniff = None
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        extra = self.extra or {}
+        if self.kind or "name" in extra:
+            yield "name"
+        yield "type"
+        yield "server"
+        yield "port"
+        if self.kind == Node.IPPORT and "udp" not in extra:
+            yield "udp"
+        if self.sniff is not None:
+            yield "sniff"
+        for k in extra:
+            if k != "name" and not k.startswith("_"):
+                yield k
+        if self.delay is not None:
+            yield "delay"
+        for k in extra:
+            if k.startswith("_"):
+                yield k
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Node({self.to_dict()!r})"
+
+    def copy(self) -> "Node":
+        n = Node(self.type, None, self.port, self.kind, self.sniff, dict(self.extra) if self.extra else None)
+        n._ip, n._host, n.delay = self._ip, self._host, self.delay
+        return n
+
+    def to_dict(self, internal: bool = True) -> Dict:
+        """按迭代顺序展开为普通 dict；internal=False 时去掉以 _ 开头的内部字段"""
+        extra = self.extra or {}
+        d = {}
+        if "name" in extra:
+            d["name"] = extra["name"]
+        elif self.kind:
+            d["name"] = self._auto_name()
+        d["type"] = self.type
+        d["server"] = self.server
+        d["port"] = self.port
+        if self.kind == Node.IPPORT and "udp" not in extra:
+            d["udp"] = False
+        if self.sniff is not None:
+            d["sniff"] = self.sniff
+        for k, v in extra.items():
+            if k != "name" and not k.startswith("_"):
+                d[k] = v
+        if self.delay is not None:
+            d["delay"] = self.delay
+        if internal:
+            for k, v in extra.items():
+                if k.startswith("_"):
+                    d[k] = v
+        return d
+
+    def to_clash(self) -> Dict:
+        """Clash 代理条目：去掉以 _ 开头的内部字段"""
+        return self.to_dict(internal=False)
+
+def endpoint_node(host: str, port: int, protos, ip: Optional[int] = None) -> Node:
+    """IP:PORT 端点候选；协议齐全时共享 IPPORT_PROTOS 元组"""
+    protos = IPPORT_PROTOS if tuple(protos) == IPPORT_PROTOS else list(protos)
+    return Node("endpoint", host, port, Node.ENDPOINT, sniff=protos, ip=ip)
+
+def ipport_node(proto: str, host: str, port: int) -> Node:
+    return Node(proto, host, port, Node.IPPORT)
+
+def as_node(d) -> Node:
+    return d if isinstance(d, Node) else Node.from_dict(d)
+
+def json_default(o):
+    """json.dumps 的 default：Node 转 dict，其余转字符串"""
+    return o.to_dict() if isinstance(o, Node) else str(o)
+
+# ===================== CDN / anycast 网段索引（IP:PORT 候选测速前分类） =====================
+# Cloudflare 公布的 IPv4 网段（https://www.cloudflare.com/ips-v4）；这些地址对 80/443/8443 等端口总能建连，并非代理
+CDN_DEFAULT_RANGES = (
+    "173.245.48.0/20", "103.21.244.0/22", "103.22.200.0/22", "103.31.4.0/22", "141.101.64.0/18",
+    "108.162.192.0/18", "190.93.240.0/20", "188.114.96.0/20", "197.234.240.0/22", "198.41.128.0/17",
+    "162.158.0.0/15", "104.16.0.0/13", "104.24.0.0/14", "172.64.0.0/13", "131.0.72.0/22",
+)
+
+class RangeIndex:
+    """
+    IPv4 网段索引：CIDR 展开为 [起, 止] uint32 区间，排序后重叠的合并，起止各存一个 array('I')，
+    查找为一次 bisect（O(log n)）。返回区间序号（-1 = 不在任何网段），序号同时用作折叠分组。
+    """
+
+    def __init__(self, entries):
+        ivs = []
+        for cidr, label in entries:
+            net = ipaddress.IPv4Network(cidr, strict=False)
+            ivs.append((int(net.network_address), int(net.broadcast_address), label))
+        ivs.sort()
+        self.starts, self.ends, self.labels = array.array("I"), array.array("I"), []
+        for lo, hi, label in ivs:
+            if self.ends and lo <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], hi)
+                continue
+            self.starts.append(lo); self.ends.append(hi); self.labels.append(label)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, ip: Optional[int]) -> int:
+        if ip is None:
+            return -1
+        i = bisect.bisect_right(self.starts, ip) - 1
+        return i if i >= 0 and ip <= self.ends[i] else -1
+
+    def classify(self, ips) -> List[int]:
+        """批量查找（压缩 IPv4 或 None 的列表）"""
+        starts, ends, right = self.starts, self.ends, bisect.bisect_right
+        out = []
+        for ip in ips:
+            i = right(starts, ip) - 1 if ip is not None else -1
+            out.append(i if i >= 0 and ip <= ends[i] else -1)
+        return out
+
+    @staticmethod
+    def read_ranges(path: str) -> List[Tuple[str, str]]:
+        """读取网段文件：每行 "CIDR [标签]"，# 起注释；IPv6 与无法解析的行跳过"""
+        out, bad = [], 0
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.split("#", 1)[0].split()
+                if not parts:
+                    continue
+                try:
+                    ipaddress.IPv4Network(parts[0], strict=False)
+                except ValueError:
+                    bad += 1
+                    continue
+                out.append((parts[0], parts[1] if len(parts) > 1 else "cdn"))
+        if bad:
+            print(f"[CDN] {path}：跳过 {bad} 行无效 / 非 IPv4 网段")
+        return out
 
-        # Base64 列表（纯订阅体）
-        if "://" not in text and re.search(r"^[A-Za-z0-9+/=\n\r]+$", text) and len(text) > 64:
+_CDN_INDEX: Optional[RangeIndex] = None
+
+def cdn_index() -> RangeIndex:
+    """内置 Cloudflare 网段 + CDN_RANGES_FILE（存在时），首次使用时构建"""
+    global _CDN_INDEX
+    if _CDN_INDEX is None:
+        entries = [(c, "cloudflare") for c in CDN_DEFAULT_RANGES]
+        if CDN_RANGES_FILE and os.path.exists(CDN_RANGES_FILE):
+            entries += RangeIndex.read_ranges(CDN_RANGES_FILE)
+        _CDN_INDEX = RangeIndex(entries)
+    return _CDN_INDEX
+
+def cdn_group_key(r: int, port: int) -> Tuple:
+    """collapse 策略的去重键（与节点去重键共用 seen：节点键是 int / 三元组，不会冲突）"""
+    return ("cdn", r, port)
+
+# ===================== 抓取与初步解析 =====================
+def parse_source(url: str, text: str, seen: set) -> List[Dict]:
+    """解析单个源的文本，按全局 seen 去重，返回新增节点"""
+    # Base64 列表（纯订阅体）
+    if "://" not in text and re.search(r"^[A-Za-z0-9+/=\n\r]+$", text) and len(text) > 64:
+        with STATS.stage("decode"):
             try:
                 text = base64.b64decode(b64pad(text)).decode("utf-8","ignore")
-            except Exception:
-                pass
+                STATS.add("decode", items=1, bytes=len(text))
+            except Exception as e:
+                STATS.error("decode", type(e).__name__)
 
+    cands = []   # [((type, server, port), 节点 dict)]，去重后才转成 Node
+    with STATS.stage("parse"):
         # 1) 协议链接
-        for lk in extract_proto_links(text):
-            p = None
-            if lk.startswith("ss://"): p = parse_ss(lk)
-            elif lk.startswith("ssr://"): p = parse_ssr(lk)
-            elif lk.startswith("sip002://"): p = parse_sip002(lk)
-            elif lk.startswith("vmess://"): p = parse_vmess(lk)
-            elif lk.startswith("trojan://"): p = parse_trojan(lk)
-            elif lk.startswith("vless://"): p = parse_vless(lk)
+        tokens = list(scan_proto_links(text))
+        invalid = 0
+        for p in parse_tokens(tokens):
             if p:
-                key = (p["type"], p["server"], p["port"])
-                if key not in seen:
-                    seen.add(key); nodes.append(p)
+                cands.append(((p["type"], p["server"], p["port"]), p))
+            else:
+                invalid += 1
+        if invalid:
+            STATS.error("parse", "invalid_link", invalid)
 
         # 2) YAML（Clash）
         if "proxies:" in text or url.endswith((".yaml",".yml")):
@@ -436,75 +1228,968 @@ def collect_nodes() -> List[Dict]:
                     for p in data["proxies"]:
                         t = p.get("type"); host = p.get("server"); port = safe_int(p.get("port"))
                         if t and host and port:
-                            key = (t, host, port)
-                            if key not in seen:
-                                seen.add(key); nodes.append(p)
-            except Exception:
-                pass
-
-        # 3) IP:PORT → socks4/5/http
-        for host, port in extract_ipports(text):
-            for proto in ("socks5","socks4","http"):
-                key = (proto, host, port)
-                if key in seen:
+                            cands.append(((t, host, port), p))
+            except Exception as e:
+                STATS.error("parse", f"yaml_{type(e).__name__}")
+
+        # 3) IP:PORT
+        eps = extract_ipports(text)
+        STATS.add("parse", items=len(cands) + len(eps), links=len(tokens), bytes=len(text))
+
+    nodes = []
+    with STATS.stage("dedup"):
+        for key, p in cands:
+            key = node_key(*key)
+            if key not in seen:
+                seen.add(key); nodes.append(Node.from_dict(p))
+        # IP:PORT → 单个端点候选，测速时嗅探实际支持的 socks5/socks4/http；CDN 网段内的按 CDN_POLICY 处理
+        ips = [pack_ipv4(host) for host, _ in eps]
+        index = cdn_index() if CDN_POLICY != "off" and eps else None
+        ranges = index.classify(ips) if index is not None else itertools.repeat(-1)
+        cdn = collections.Counter()
+        for (host, port), ip, r in zip(eps, ips, ranges):
+            keys = node_keys(IPPORT_PROTOS, host, port, ip)
+            protos = [proto for proto, key in zip(IPPORT_PROTOS, keys) if key not in seen]
+            if not protos:
+                continue
+            if r >= 0:
+                if CDN_POLICY == "skip":
+                    cdn["cdn_skipped"] += 1
                     continue
-                seen.add(key)
-                nodes.append({
-                    "name": f"{proto.upper()}_{host}_{port}",
-                    "type": proto,
-                    "server": host,
-                    "port": port,
-                    "udp": False
-                })
+                if CDN_POLICY == "collapse":
+                    gk = cdn_group_key(r, port)
+                    if gk in seen:
+                        cdn["cdn_collapsed"] += 1
+                        continue
+                    seen.add(gk)
+                    cdn["cdn_kept"] += 1              # 每个 (网段, 端口) 留下的代表
+                else:
+                    cdn["cdn_tagged"] += 1
+            seen.update(keys)
+            node = endpoint_node(host, port, protos, ip)
+            if r >= 0:
+                node["_cdn"] = index.labels[r]
+            nodes.append(node)
+        STATS.add("dedup", items=len(cands) + len(eps), kept=len(nodes), **cdn)
+    return nodes
+
+def collect_nodes() -> List[Dict]:
+    nodes, seen = [], set()
+    texts, report = fetch_all(SOURCES)
+    print_fetch_report(report)
+    for url, text in zip(SOURCES, texts):
+        if not text:
+            continue
+        nodes += parse_source(url, text, seen)
+    shutdown_parse_pool()
     print(f"[Collect] 初步收集: {len(nodes)}")
     return nodes
 
+# ===================== 共享 DNS 解析缓存（本次运行有效） =====================
+def is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+def _dns_query(name: str, qid: int, qtype: int = 1) -> bytes:
+    """qtype：1=A，28=AAAA"""
+    qname = b"".join(bytes([len(p)]) + p for p in name.rstrip(".").encode("idna").split(b".")) + b"\x00"
+    return qid.to_bytes(2, "big") + b"\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00" + qname + \
+        qtype.to_bytes(2, "big") + b"\x00\x01"
+
+def _dns_skip_name(data: bytes, pos: int) -> int:
+    while True:
+        ln = data[pos]
+        if ln & 0xC0 == 0xC0:
+            return pos + 2
+        if ln == 0:
+            return pos + 1
+        pos += ln + 1
+
+def _dns_parse_addrs(data: bytes, qid: int) -> List[str]:
+    if len(data) < 12 or int.from_bytes(data[:2], "big") != qid or data[3] & 0x0F:
+        return []
+    qd, an = int.from_bytes(data[4:6], "big"), int.from_bytes(data[6:8], "big")
+    pos = 12
+    for _ in range(qd):
+        pos = _dns_skip_name(data, pos) + 4
+    out = []
+    for _ in range(an):
+        pos = _dns_skip_name(data, pos)
+        rtype, rdlen = int.from_bytes(data[pos:pos+2], "big"), int.from_bytes(data[pos+8:pos+10], "big")
+        pos += 10
+        if rtype == 1 and rdlen == 4:
+            out.append(socket.inet_ntoa(data[pos:pos+4]))
+        elif rtype == 28 and rdlen == 16:
+            out.append(socket.inet_ntop(socket.AF_INET6, data[pos:pos+16]))
+        pos += rdlen
+    return out
+
+class _DNSProtocol(asyncio.DatagramProtocol):
+    def __init__(self, fut: asyncio.Future):
+        self.fut = fut
+
+    def datagram_received(self, data, addr):
+        if not self.fut.done():
+            self.fut.set_result(data)
+
+    def error_received(self, exc):
+        if not self.fut.done():
+            self.fut.set_exception(exc)
+
+class Resolver:
+    """
+    运行期解析缓存：成功与失败（负缓存）都缓存到本次运行结束；
+    同一主机名的并发解析合并为一次；IP 字面量直接返回，不计入统计。
+    优先 IPv4（A），没有 A 记录时取 IPv6（AAAA），与 open_connection 直接解析时可达的主机一致。
+    """
+
+    def __init__(self, backend: str = DNS_BACKEND, server=DNS_SERVER):
+        self.backend = backend
+        self.server = server
+        self.cache: Dict[str, str] = {}
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.hits = self.neg_hits = self.coalesced = self.lookups = self.failures = 0
+        self.lookup_ms = 0.0
+        self._pool = None
+
+    async def _system(self, host: str) -> List[str]:
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=DNS_WORKERS)
+        infos = await asyncio.get_running_loop().run_in_executor(
+            self._pool, socket.getaddrinfo, host, None, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        infos.sort(key=lambda info: info[0] != socket.AF_INET)   # 稳定排序：IPv4 在前
+        return [info[4][0] for info in infos]
+
+    async def _udp(self, host: str) -> List[str]:
+        return await self._udp_query(host, 1) or await self._udp_query(host, 28)
+
+    async def _udp_query(self, host: str, qtype: int) -> List[str]:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        qid = random.randrange(65536)
+        transport, _ = await loop.create_datagram_endpoint(lambda: _DNSProtocol(fut), remote_addr=tuple(self.server))
+        try:
+            transport.sendto(_dns_query(host, qid, qtype))
+            return _dns_parse_addrs(await fut, qid)
+        finally:
+            transport.close()
+
+    async def _lookup(self, host: str):
+        self.lookups += 1
+        start = time.perf_counter()
+        try:
+            fn = self._udp if self.backend == "udp" else self._system
+            addrs = await asyncio.wait_for(fn(host), timeout=DNS_TIMEOUT)
+        except Exception:
+            addrs = []
+        self.lookup_ms += (time.perf_counter() - start) * 1000.0
+        if not addrs:
+            self.failures += 1
+        return addrs[0] if addrs else None
+
+    async def resolve(self, host: str):
+        """返回 IP 字符串（优先 IPv4），解析失败返回 None"""
+        if is_ip(host):
+            return host
+        while True:
+            if host in self.cache:
+                if self.cache[host] is None:
+                    self.neg_hits += 1
+                else:
+                    self.hits += 1
+                return self.cache[host]
+            shared = self.inflight.get(host)
+            if shared is None:
+                break
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(shared)
+            except asyncio.CancelledError:
+                if not shared.cancelled():       # 本任务自身被取消
+                    raise
+                # 发起解析的任务被取消：重新查缓存，无人接手时由本任务重新解析
+        fut = asyncio.get_running_loop().create_future()
+        self.inflight[host] = fut
+        try:
+            ip = await self._lookup(host)
+            self.cache[host] = ip
+            fut.set_result(ip)
+            return ip
+        finally:
+            del self.inflight[host]
+            if not fut.done():
+                fut.cancel()                     # 等待者据此重试，而不是把取消当成解析失败
+
+    def stats(self) -> Dict:
+        asked = self.hits + self.neg_hits + self.coalesced + self.lookups
+        return {
+            "backend": self.backend,
+            "queries": asked,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "negative_hits": self.neg_hits,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "hit_rate": round((asked - self.lookups) / asked, 3) if asked else 0.0,
+            "avg_lookup_ms": round(self.lookup_ms / self.lookups, 1) if self.lookups else 0.0,
+        }
+
+RESOLVER = Resolver()
+
+async def open_conn(host: str, port: int, timeout: float):
+    """经共享解析缓存解析后建立连接；返回 (reader, writer)"""
+    ip = await RESOLVER.resolve(host)
+    if ip is None:
+        raise OSError(f"DNS 解析失败: {host}")
+    return await asyncio.wait_for(asyncio.open_connection(host=ip, port=int(port)), timeout=timeout)
+
+# ===================== 自适应并发控制（AIMD） =====================
+LOCAL_ERRNOS = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.EADDRNOTAVAIL, errno.ENOMEM}
+
+def conn_outcome(e: BaseException) -> str:
+    """连接失败归类：timeout / local（本机资源耗尽）/ error（对端拒绝、不可达等）"""
+    if isinstance(e, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(e, OSError) and e.errno in LOCAL_ERRNOS:
+        return "local"
+    return "error"
+
+def fd_budget(per_probe: int = 2) -> int:
+    """按 RLIMIT_NOFILE（尽量提升软限制到硬限制）估算可同时进行的探测数"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            with contextlib.suppress(Exception):
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+                soft = hard
+        if soft == resource.RLIM_INFINITY:
+            return CONCURRENCY_MAX
+        return max(CONCURRENCY_MIN, min(CONCURRENCY_MAX, (soft - FD_RESERVE) // per_probe))
+    except Exception:
+        return CONCURRENCY_MAX
+
+class AdaptiveLimiter:
+    """
+    可变上限的异步信号量（FIFO 唤醒）。每 ADAPT_WINDOW 个探测结果评估一次：
+    出现本机资源错误 → 减半；中位延迟膨胀或超时率明显高于基线 → ×0.75；否则 +ADAPT_STEP。
+    adaptive=False 时等价于固定 CONCURRENCY 的信号量。history 记录 (秒, 并发上限) 变化。
+    """
+
+    def __init__(self, start: int = CONCURRENCY, adaptive: bool = ADAPTIVE_CONCURRENCY):
+        self.adaptive = adaptive
+        self.max_limit = fd_budget() if adaptive else start
+        self.limit = float(max(1, min(start, self.max_limit)))
+        self.inflight = 0
+        self._waiters = collections.deque()
+        self._window: List[Tuple[float, str]] = []
+        self._base_med = None
+        self._base_to = None
+        self.t0 = time.monotonic()
+        self.history = [(0.0, int(self.limit))]
+
+    async def __aenter__(self):
+        if self.inflight < int(self.limit) and not self._waiters:
+            self.inflight += 1
+            return self
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.inflight -= 1
+                self._wake()
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self.inflight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.inflight < int(self.limit):
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.inflight += 1
+                fut.set_result(None)
+
+    def feedback(self, ms: float, outcome: str):
+        # 排行截断线提前放弃（cutoff）是有意为之，不反映拥塞：不进入窗口，否则堆满后超时率居高不下会把并发压到下限
+        if not self.adaptive or outcome == "cutoff":
+            return
+        self._window.append((ms, outcome))
+        if len(self._window) < ADAPT_WINDOW:
+            return
+        oks = sorted(m for m, o in self._window if o == "ok")
+        local = sum(1 for _, o in self._window if o == "local")
+        to_rate = sum(1 for _, o in self._window if o == "timeout") / len(self._window)
+        self._window = []
+        med = quantile(oks, 0.5) if oks else None
+        if med is not None:
+            # 基线取历史最小中位数，并缓慢上浮，避免被个别极快窗口锁死
+            self._base_med = med if self._base_med is None else min(med, self._base_med * 1.02)
+        self._base_to = to_rate if self._base_to is None else min(to_rate, self._base_to + 0.01)
+        old = int(self.limit)
+        if local:
+            self.limit = max(CONCURRENCY_MIN, self.limit * 0.5)
+        elif med is not None and med > self._base_med * ADAPT_INFLATION:
+            self.limit = max(CONCURRENCY_MIN, self.limit * 0.75)
+        elif to_rate > self._base_to + 0.15:
+            self.limit = max(CONCURRENCY_MIN, self.limit * 0.75)
+        else:
+            self.limit = min(self.max_limit, self.limit + ADAPT_STEP)
+        if int(self.limit) != old:
+            self.history.append((round(time.monotonic() - self.t0, 2), int(self.limit)))
+        self._wake()
+
+    def report(self) -> Dict:
+        return {
+            "adaptive": self.adaptive,
+            "fd_budget": self.max_limit,
+            "final": int(self.limit),
+            "peak": max(v for _, v in self.history),
+            "history": self.history,
+        }
+
 # ===================== 并发 TCP 测速 =====================
-async def tcp_ping(host: str, port: int, timeout: float = TIMEOUT_TCP) -> float:
+class LatencyTracker:
+    """本次运行成功建连的延迟窗口；每新增 64 个样本按分位数重算一次自适应超时"""
+
+    def __init__(self, window: int = 4096):
+        self.samples = collections.deque(maxlen=window)
+        self.timeout = TIMEOUT_TCP
+        self._pending = 0
+
+    def observe(self, ms: float):
+        self.samples.append(ms)
+        self._pending += 1
+        if ADAPTIVE_TIMEOUT and self._pending >= 64 and len(self.samples) >= ADAPT_MIN_SAMPLES:
+            self._pending = 0
+            q = quantile(sorted(self.samples), ADAPT_TIMEOUT_QUANTILE)
+            self.timeout = min(TIMEOUT_TCP, max(ADAPT_TIMEOUT_MIN, q * ADAPT_TIMEOUT_FACTOR / 1000.0))
+
+LATENCY = LatencyTracker()
+
+# —— 可插拔建连后端：只关心三次握手是否完成，不需要读写时可绕过 Stream 对象 ——
+async def _connect_stream(ip: str, port: int, timeout: float):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host=ip, port=port), timeout=timeout)
+    writer.close()
+    with contextlib.suppress(Exception):
+        await writer.wait_closed()
+
+async def _connect_sock(ip: str, port: int, timeout: float):
+    s = socket.socket(socket.AF_INET6 if ":" in ip else socket.AF_INET, socket.SOCK_STREAM)
+    s.setblocking(False)
+    try:
+        await asyncio.wait_for(asyncio.get_running_loop().sock_connect(s, (ip, port)), timeout=timeout)
+    finally:
+        s.close()
+
+async def _connect_raw(ip: str, port: int, timeout: float):
+    loop = asyncio.get_running_loop()
+    s = socket.socket(socket.AF_INET6 if ":" in ip else socket.AF_INET, socket.SOCK_STREAM)
+    s.setblocking(False)
+    # 关闭时直接 RST，避免十万级探测堆积 TIME_WAIT
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    try:
+        err = s.connect_ex((ip, port))
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            fut = loop.create_future()
+            fd = s.fileno()
+            loop.add_writer(fd, lambda: fut.done() or fut.set_result(None))
+            try:
+                await asyncio.wait_for(fut, timeout=timeout)
+            finally:
+                loop.remove_writer(fd)
+            err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise OSError(err, os.strerror(err))
+    finally:
+        s.close()
+
+SCAN_BACKENDS = {"stream": _connect_stream, "sock": _connect_sock, "raw": _connect_raw}
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """USE_UVLOOP 且已安装 uvloop 时返回 uvloop 事件循环，否则返回标准循环"""
+    if USE_UVLOOP:
+        try:
+            import uvloop
+            return uvloop.new_event_loop()
+        except ImportError:
+            pass
+    return asyncio.new_event_loop()
+
+async def tcp_connect(host: str, port: int, timeout: float = None, backend: str = None) -> Tuple[float, str]:
+    """返回 (延迟ms 或 -1, 结果归类 ok/timeout/local/error/dns)"""
+    timeout = LATENCY.timeout if timeout is None else timeout
+    connect = SCAN_BACKENDS[backend or SCAN_BACKEND]
+    ip = await RESOLVER.resolve(host)    # 解析耗时不计入延迟
+    if ip is None:
+        return -1.0, "dns"
     start = time.perf_counter()
     try:
-        fut = asyncio.open_connection(host=host, port=int(port))
-        reader, writer = await asyncio.wait_for(fut, timeout=timeout)
-        writer.close()
-        with contextlib.suppress(Exception):
-            await writer.wait_closed()
-        return (time.perf_counter() - start) * 1000.0
+        await connect(ip, int(port), timeout)
+        return (time.perf_counter() - start) * 1000.0, "ok"
+    except Exception as e:
+        return -1.0, conn_outcome(e)
+
+async def tcp_ping(host: str, port: int, timeout: float = None, backend: str = None) -> float:
+    return (await tcp_connect(host, port, timeout, backend))[0]
+
+# ===================== 协议握手（SOCKS5 / SOCKS4 / HTTP CONNECT） =====================
+
+def socks5_greeting() -> bytes:
+    return b"\x05\x01\x00"                      # VER=5, 1 种方法：无认证
+
+def socks4_request(host: str, port: int) -> bytes:
+    try:
+        return b"\x04\x01" + int(port).to_bytes(2, "big") + socket.inet_aton(host) + b"\x00"
+    except OSError:
+        # SOCKS4a：IP 置 0.0.0.1，域名附在 USERID 之后
+        return b"\x04\x01" + int(port).to_bytes(2, "big") + b"\x00\x00\x00\x01\x00" + host.encode() + b"\x00"
+
+def http_connect_request(host: str, port: int) -> bytes:
+    return f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode()
+
+def socks5_greeting_ok(reply: bytes) -> bool:
+    return reply[:2] == b"\x05\x00"
+
+def socks4_reply_ok(reply: bytes) -> bool:
+    """只认 0x5A（请求已批准）；0x5B 表示拒绝 / 失败，对所有请求都拒绝的端点不算可用"""
+    return len(reply) >= 2 and reply[0] == 0 and reply[1] == 0x5A
+
+def http_connect_ok(reply: bytes) -> bool:
+    return reply.startswith(b"HTTP/1.") and reply[9:10] == b"2"
+
+# 协议 → (请求构造, 读取字节数, 应答判定)
+SNIFF_HANDSHAKES = {
+    "socks5": (lambda host, port: socks5_greeting(), 2, socks5_greeting_ok),
+    "socks4": (socks4_request, 8, socks4_reply_ok),
+    "http":   (http_connect_request, 12, http_connect_ok),
+}
+
+async def read_upto(reader: asyncio.StreamReader, n: int) -> bytes:
+    try:
+        return await reader.readexactly(n)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+async def exchange(reader, writer, payload: bytes, n: int, timeout: float) -> bytes:
+    writer.write(payload)
+    await writer.drain()
+    return await asyncio.wait_for(read_upto(reader, n), timeout=timeout)
+
+async def close_writer(writer):
+    writer.close()
+    with contextlib.suppress(Exception):
+        await asyncio.wait_for(writer.wait_closed(), timeout=1.0)
+
+async def _sniff_on(reader, writer, proto: str) -> Tuple[bool, bytes]:
+    build, nbytes, ok = SNIFF_HANDSHAKES[proto]
+    try:
+        reply = await exchange(reader, writer, build(*SNIFF_TARGET), nbytes, SNIFF_TIMEOUT)
     except Exception:
-        return -1.0
+        return False, b""
+    return ok(reply), reply
 
-async def test_all_tcp(nodes: List[Dict]) -> List[Dict]:
-    sem = asyncio.Semaphore(CONCURRENCY); out = []
-    async def test_one(n):
+async def _sniff_fresh(host: str, port: int, proto: str, timeout: float) -> bool:
+    try:
+        reader, writer = await open_conn(host, port, timeout)
+    except Exception:
+        return False
+    try:
+        return (await _sniff_on(reader, writer, proto))[0]
+    finally:
+        await close_writer(writer)
+
+async def sniff_endpoint(host: str, port: int, protos=IPPORT_PROTOS,
+                         timeout: float = None) -> Tuple[float, List[str], str]:
+    """
+    端点级嗅探：首个连接测 TCP 延迟并发送第一种协议的握手；不可达的端点只花一次连接。
+    可达时其余协议各用一个新连接并发握手；首个应答若是 HTTP 报文，则跳过 SOCKS 尝试。
+    返回 (延迟ms 或 -1, 实际应答的协议列表, 首个连接的结果归类)
+    """
+    protos = list(protos)
+    timeout = LATENCY.timeout if timeout is None else timeout
+    start = time.perf_counter()
+    try:
+        reader, writer = await open_conn(host, port, timeout)
+    except Exception as e:
+        return -1.0, [], conn_outcome(e)
+    delay = (time.perf_counter() - start) * 1000.0
+    try:
+        first_ok, reply = await _sniff_on(reader, writer, protos[0])
+    finally:
+        await close_writer(writer)
+    rest = protos[1:]
+    if reply.startswith(b"HT"):
+        rest = [p for p in rest if p == "http"]
+    oks = await asyncio.gather(*(_sniff_fresh(host, port, p, timeout) for p in rest))
+    found = {p for p, ok in zip(rest, oks) if ok}
+    if first_ok:
+        found.add(protos[0])
+    return delay, [p for p in protos if p in found], "ok"
+
+async def probe_node(n: Dict, sem: AdaptiveLimiter, ranking=None,
+                     backend: str = None) -> Tuple[List[Dict], str]:
+    """
+    测速单个候选，返回 (可用节点, 结果归类)（端点候选按嗅探结果展开为 0~3 个节点）。
+    给定 ranking 时，超时取自适应超时与该协议 Top-K 截断线的较小者；
+    因截断线超时的归为 "cutoff"：节点只是慢于第 K 名，不算失败（不计错误、不记入健康库）。
+    """
+    endpoint = n.get("type") == "endpoint"
+    types = n.get("sniff", IPPORT_PROTOS) if endpoint else [(n.get("type") or "").lower()]
+    async with sem:
+        base = LATENCY.timeout
+        timeout = ranking.timeout_for(types, base) if ranking else base
+        if endpoint:
+            d, found, outcome = await sniff_endpoint(n["server"], n["port"], types, timeout)
+        else:
+            d, outcome = await tcp_connect(n["server"], n["port"], timeout, backend)
+            found = [n] if d > 0 else []
+    if outcome == "timeout" and timeout < base:
+        outcome = "cutoff"
+    sem.feedback(d, outcome)
+    if found:
+        LATENCY.observe(d)
+    elif outcome == "ok":
+        outcome = "no_protocol"
+    STATS.add("probe", items=1, alive=len(found))
+    if outcome == "cutoff":
+        STATS.add("probe", cutoff=1)
+    elif outcome != "ok":
+        STATS.error("probe", outcome)
+    if not endpoint:
+        if found:
+            n["delay"] = round(d, 1)
+        return found, outcome
+    out = []
+    cdn = n.get("_cdn")
+    for proto in found:
+        node = ipport_node(proto, n["server"], n["port"])
+        node["delay"] = round(d, 1)
+        if cdn:
+            node["_cdn"] = cdn
+        out.append(node)
+    return out, outcome
+
+# —— 多次采样：Top 候选再测若干次，记录 min / 中位数 / p90 / 抖动 / 丢失 ——
+async def sample_latency(n: Dict, count: int = SAMPLE_COUNT, backend: str = None):
+    samples = [n["delay"]] if n.get("delay") else []
+    lost = 0
+    for _ in range(count - len(samples)):
+        d = await tcp_ping(n["server"], n["port"], backend=backend)
+        if d > 0:
+            samples.append(round(d, 1))
+        else:
+            lost += 1
+    if not samples:
+        return
+    ordered = sorted(samples)
+    n["_d_min"] = ordered[0]
+    n["_d_med"] = round(quantile(ordered, 0.5), 1)
+    n["_d_p90"] = round(quantile(ordered, 0.9), 1)
+    n["_jitter"] = round(sum(abs(a - b) for a, b in zip(samples, samples[1:])) / max(1, len(samples) - 1), 1)
+    n["_loss"] = lost
+    n["delay"] = {"min": n["_d_min"], "median": n["_d_med"], "p90": n["_d_p90"]}.get(DELAY_STAT, n["delay"])
+
+async def resample_top(by_type: Dict[str, List[Dict]], backend: str = None) -> int:
+    """by_type 各列表已按首轮延迟排好序；每协议取前 SAMPLE_TOP_PER_TYPE 个做多次采样，返回采样节点数"""
+    sem = asyncio.Semaphore(CONCURRENCY)
+    async def one(n):
         async with sem:
-            d = await tcp_ping(n["server"], n["port"])
-            if d > 0:
-                n["delay"] = round(d, 1); out.append(n)
-    await asyncio.gather(*(test_one(n) for n in nodes))
-    return out
+            await sample_latency(n, backend=backend)
+    top = [n for lst in by_type.values() for n in lst[:SAMPLE_TOP_PER_TYPE]]
+    await asyncio.gather(*(one(n) for n in top))
+    return len(top)
+
+# ===================== 节点健康库（跨运行持久化 + 指数退避） =====================
+class HealthDB:
+    """
+    以 (type, server, port) 为键的紧凑 JSON 库，每条记录：
+      s=最近一次在源中出现, c=最近一次测速, a=最近一次存活, f=连续失败次数, d=最近延迟(ms)
+    """
+
+    def __init__(self, path: str = HEALTH_PATH):
+        self.path = path
+        self.now = int(time.time())
+        self.skipped = 0
+        self.sampled = 0
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.db: Dict[str, Dict] = json.load(f)
+        except Exception:
+            self.db = {}
+
+    @staticmethod
+    def key(n: Dict) -> str:
+        return f"{(n.get('type') or '').lower()}|{n.get('server')}|{n.get('port')}"
+
+    def backoff(self, fails: int) -> float:
+        return min(HEALTH_BACKOFF_MAX, HEALTH_BACKOFF_BASE * 2 ** (fails - 1)) if fails > 0 else 0.0
+
+    def should_probe(self, n: Dict) -> bool:
+        """返回 False 表示处于退避期且未被抽中复测；被抽中的节点会打上 _revive 标记"""
+        rec = self.db.setdefault(self.key(n), {"s": 0, "c": 0, "a": 0, "f": 0, "d": []})
+        rec["s"] = self.now
+        if self.now - rec["c"] >= self.backoff(rec["f"]):
+            return True
+        if random.random() < HEALTH_REVIVE_SAMPLE:
+            self.sampled += 1
+            n["_revive"] = True
+            return True
+        self.skipped += 1
+        return False
 
-# ===================== Google 严格验证（仅 socks4/5/http） =====================
-def google_via_socks_http(n: Dict) -> bool:
-    host, port = n["server"], int(n["port"])
-    try:
-        if n["type"].lower() in ("socks5","socks4"):
-            s = socks.socksocket()
-            s.set_proxy(socks.SOCKS5 if n["type"]=="socks5" else socks.SOCKS4, host, port)
-            s.settimeout(SOCKS_GOOGLE_TIMEOUT)
-            s.connect(("www.google.com", 80))
-            s.close()
+    def order(self, nodes: List[Dict]) -> List[Dict]:
+        """过滤掉退避中的节点；抽样复测的排在最后（降低优先级）"""
+        keep = [n for n in nodes if self.should_probe(n)]
+        return [n for n in keep if not n.get("_revive")] + [n for n in keep if n.pop("_revive", False)]
+
+    def record(self, n: Dict, delay):
+        self.record_key(self.key(n), delay)
+
+    def record_key(self, key: str, delay):
+        """按键记录一次测速结果（分片合并时直接回放各分片的测速日志）"""
+        self.now = int(time.time())        # 守护模式下同一个库会用上几天，每次记录都取当前时间
+        rec = self.db.setdefault(key, {"s": self.now, "c": 0, "a": 0, "f": 0, "d": []})
+        rec["s"] = rec["c"] = self.now      # 测到即视为仍在源中（--merge 只回放测速日志，不经过 order）
+        if delay is not None and delay > 0:
+            rec["a"] = self.now
+            rec["f"] = 0
+            rec["d"] = (rec["d"] + [delay])[-HEALTH_KEEP_DELAYS:]
+        else:
+            rec["f"] += 1
+
+    def compact(self):
+        self.now = int(time.time())
+        before = len(self.db)
+        self.db = {k: v for k, v in self.db.items() if self.now - v.get("s", 0) <= HEALTH_EXPIRE}
+        return before - len(self.db)
+
+    def snapshot(self) -> Tuple[Dict, int]:
+        """清理过期记录并返回 (记录副本, 清理数)；副本可交给其他线程写盘，不受之后的 record 影响"""
+        dropped = self.compact()
+        return {k: dict(v) for k, v in self.db.items()}, dropped
+
+    def save(self, snap: Tuple[Dict, int] = None):
+        db, dropped = snap if snap is not None else self.snapshot()
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(db, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+        print(f"[Health] 跳过(退避) {self.skipped}，抽样复测 {self.sampled}，"
+              f"记录 {len(db)}，清理过期 {dropped}")
+
+# ===================== 流式 Top-K 排行（每协议有界，边测边更新） =====================
+class Ranking:
+    """
+    每协议一个容量为 k 的最大堆（按 rank_value），只保留最快的 k 个节点。
+    堆满后第 k 名的值即该协议的截断线：之后的探测超时收紧到该值，更慢的探测提前放弃。
+    """
+
+    def __init__(self, k: int = KEEP_TOP_PER_TYPE):
+        self.k = k
+        self.heaps: Dict[str, List] = {}
+        self._seq = itertools.count()
+        self.rejected = 0
+
+    def push(self, n: Dict) -> bool:
+        h = self.heaps.setdefault((n.get("type") or "").lower(), [])
+        item = (-rank_value(n), -next(self._seq), n)
+        if len(h) < self.k:
+            heapq.heappush(h, item)
             return True
-        elif n["type"].lower() == "http":
-            # 这里只作直连 80 的弱验证（严格 CONNECT 需实现隧道）
-            s = socket.create_connection(("www.google.com", 80), timeout=SOCKS_GOOGLE_TIMEOUT)
-            s.close()
+        self.rejected += 1                 # 无论新节点入选与否，都有一个节点出局
+        if item[0] > h[0][0]:
+            heapq.heapreplace(h, item)
             return True
+        return False
+
+    def cutoff(self, t: str):
+        """该协议堆满时返回第 k 名的值(ms)，否则 None"""
+        h = self.heaps.get(t)
+        return -h[0][0] if h and len(h) >= self.k else None
+
+    def timeout_for(self, types, default: float) -> float:
+        """候选可能归入的所有协议都已有截断线时，超时收紧为其中最宽松者"""
+        cuts = [self.cutoff(t) for t in types]
+        if not cuts or any(c is None for c in cuts):
+            return default
+        return min(default, max(cuts) / 1000.0)
+
+    def rerank(self):
+        """节点的排序值变化后（多次采样 / 应用层测速）重建各堆"""
+        for t, h in self.heaps.items():
+            self.heaps[t] = [(-rank_value(n), seq, n) for _, seq, n in h]
+            heapq.heapify(self.heaps[t])
+
+    def ranked(self, t: str) -> List[Dict]:
+        return [n for _, _, n in sorted(self.heaps.get(t, []), key=lambda x: (-x[0], -x[1]))]
+
+    def by_type(self) -> Dict[str, List[Dict]]:
+        return {t: self.ranked(t) for t in self.heaps}
+
+# ===================== 流式流水线：抓取 → 解析 → 测速 重叠执行 =====================
+async def run_pipeline(urls: List[str], health: HealthDB = None,
+                       sink: List[Dict] = None, backend: str = None) -> Tuple[int, Ranking]:
+    """
+    各源并发抓取，按源顺序依次解析（去重集合全局共享，同一节点总是保留排在前面的源里的那份，
+    与串行收集结果一致），每个源解析完新节点立刻进入测速。
+    给定 health 时跳过退避中的节点，并记录每个候选的测速结果。
+    给定 sink 时追加每个新候选的测速前副本（供写 candidates 快照）。
+    backend 选择建连后端（见 SCAN_BACKENDS），默认 SCAN_BACKEND。
+    返回 (初步收集数, 每协议 Top-K 排行)，排行在测速完成时实时更新。
+    """
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + FETCH_DEADLINE
+    session = make_session()
+    fetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+    parse_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)  # 串行解析，seen 无需加锁
+    sem = AdaptiveLimiter()
+    seen: set = set()
+    ranking = Ranking()
+    report: List[Dict] = [{} for _ in urls]
+    probes = []
+    collected = 0
+
+    async def test_one(n):
+        with STATS.stage("probe"):
+            alive, outcome = await probe_node(n, sem, ranking, backend)
+        if health is not None and outcome != "cutoff":
+            health.record(n, alive[0]["delay"] if alive else None)
+        for x in alive:
+            ranking.push(x)
+
+    try:
+        # 抓取全部并发发出；解析按源顺序等待各自的抓取结果，完成顺序不影响去重保留哪一份
+        fetches = [loop.run_in_executor(fetch_pool, fetch_source, session, u, deadline) for u in urls]
+        for i, url in enumerate(urls):
+            text, report[i] = await fetches[i]
+            if not text:
+                continue
+            new = await loop.run_in_executor(parse_pool, parse_source, url, text, seen)
+            collected += len(new)
+            if sink is not None:
+                sink.extend(n.copy() for n in new)
+            print(f"[Pipeline] +{len(new)} 节点 ← {url}")
+            if health is not None:
+                new = health.order(new)
+            probes.extend(asyncio.ensure_future(test_one(n)) for n in new)
+        await asyncio.gather(*probes)
+    finally:
+        fetch_pool.shutdown(wait=False, cancel_futures=True)
+        parse_pool.shutdown(wait=False)
+        shutdown_parse_pool()
+    print_fetch_report(report)
+    RUN_REPORT["fetch"] = report
+    RUN_REPORT["concurrency"] = sem.report()
+    print(f"[Collect] 初步收集: {collected}，排行淘汰/提前放弃 {ranking.rejected}")
+    return collected, ranking
+
+async def probe_candidates(nodes: List[Dict], health: HealthDB = None, backend: str = None) -> Ranking:
+    """对已收集的候选（如 candidates 快照）做与 run_pipeline 相同的测速 + Top-K 排行"""
+    sem = AdaptiveLimiter()
+    ranking = Ranking()
+
+    async def test_one(n):
+        with STATS.stage("probe"):
+            alive, outcome = await probe_node(n, sem, ranking, backend)
+        if health is not None and outcome != "cutoff":
+            health.record(n, alive[0]["delay"] if alive else None)
+        for x in alive:
+            ranking.push(x)
+
+    if health is not None:
+        nodes = health.order(nodes)
+    await asyncio.gather(*(test_one(n) for n in nodes))
+    RUN_REPORT["concurrency"] = sem.report()
+    print(f"[Probe] 候选 {len(nodes)}，排行淘汰/提前放弃 {ranking.rejected}")
+    return ranking
+
+# ===================== 应用层测速（TLS 握手 / WebSocket 升级，仅 TCP 可用节点） =====================
+APP_PROBE_TYPES = ("trojan", "vless", "vmess")
+
+def rank_value(n: Dict) -> float:
+    """按 RANK_KEY 取排序值；未做应用层测速的节点退回 TCP 延迟，应用层测速失败的排到最后"""
+    if RANK_KEY != "delay" and n.get(RANK_KEY) is not None:
+        return n[RANK_KEY]
+    base = n.get("delay", 9e9)
+    return base + 9e9 if RANK_KEY != "delay" and n.get("_app_fail") else base
+
+_TLS_CTX: Optional[ssl.SSLContext] = None
+
+def _tls_context() -> ssl.SSLContext:
+    """进程内共享一个 SSLContext：每次新建都要重新加载系统 CA，高并发下内存与耗时都很可观"""
+    global _TLS_CTX
+    if _TLS_CTX is not None:
+        return _TLS_CTX
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE      # 免费节点多为自签证书，只测握手耗时
+    ctx.set_alpn_protocols(["http/1.1"])
+    _TLS_CTX = ctx
+    return ctx
+
+def _app_params(n: Dict) -> Tuple[bool, str, str, str]:
+    """返回 (是否 TLS, SNI, ws 路径 或 '', ws Host)"""
+    t = (n.get("type") or "").lower()
+    ws = n.get("ws-opts") or {}
+    ws_host = (ws.get("headers") or {}).get("Host") or ""
+    tls = t == "trojan" or bool(n.get("tls"))
+    sni = n.get("sni") or n.get("servername") or ws_host or n["server"]
+    path = (ws.get("path") or "/") if n.get("network") == "ws" else ""
+    return tls, sni, path, ws_host or sni
+
+async def app_probe(n: Dict, timeout: float = APP_PROBE_TIMEOUT) -> bool:
+    """
+    在节点上记录 _tls_ms / _ws_ms / _app_ms；失败记 _app_fail；无 TLS 且非 ws 的节点不测。
+    传输参数未知的 vless（旧快照里未解析 security / type / sni 的条目）也不测，以免按错误的层级记失败。
+    """
+    if (n.get("type") or "").lower() == "vless" and "network" not in n and not n.get("servername"):
+        return True
+    tls, sni, path, ws_host = _app_params(n)
+    if not tls and not path:
+        return True
+    writer = None
+    try:
+        t0 = time.perf_counter()
+        reader, writer = await open_conn(n["server"], n["port"], timeout)
+        t1 = time.perf_counter()
+        if tls:
+            await asyncio.wait_for(writer.start_tls(_tls_context(), server_hostname=sni), timeout=timeout)
+            n["_tls_ms"] = round((time.perf_counter() - t1) * 1000.0, 1)
+        if path:
+            t2 = time.perf_counter()
+            key = base64.b64encode(os.urandom(16)).decode()
+            req = (f"GET {path} HTTP/1.1\r\nHost: {ws_host}\r\nUpgrade: websocket\r\n"
+                   f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n")
+            reply = await exchange(reader, writer, req.encode(), 12, timeout)
+            if not (reply.startswith(b"HTTP/1.") and reply[9:12] == b"101"):
+                raise ConnectionError("ws upgrade rejected")
+            n["_ws_ms"] = round((time.perf_counter() - t2) * 1000.0, 1)
+        n["_app_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+        return True
     except Exception:
+        n["_app_fail"] = True
+        return False
+    finally:
+        if writer is not None:
+            await close_writer(writer)
+
+async def app_probe_all(by_type: Dict[str, List[Dict]]) -> int:
+    """对 TCP 可用的 trojan/vless/vmess 执行应用层测速，返回通过数"""
+    sem = asyncio.Semaphore(CONCURRENCY)
+    async def one(n):
+        async with sem:
+            return await app_probe(n)
+    nodes = [n for t in APP_PROBE_TYPES for n in by_type.get(t, [])]
+    return sum(await asyncio.gather(*(one(n) for n in nodes)))
+
+# ===================== Google 严格验证（仅 socks4/5/http，原生 asyncio 隧道） =====================
+def socks5_connect_request(host: str, port: int) -> bytes:
+    try:
+        addr = b"\x01" + socket.inet_aton(host)
+    except OSError:
+        addr = b"\x03" + bytes([len(host.encode())]) + host.encode()
+    return b"\x05\x01\x00" + addr + int(port).to_bytes(2, "big")
+
+async def _socks5_tunnel(reader, writer, host: str, port: int, timeout: float) -> bool:
+    if not socks5_greeting_ok(await exchange(reader, writer, socks5_greeting(), 2, timeout)):
+        return False
+    head = await exchange(reader, writer, socks5_connect_request(host, port), 4, timeout)
+    if len(head) < 4 or head[0] != 5 or head[1] != 0:
+        return False
+    # 读掉 BND.ADDR + BND.PORT
+    if head[3] == 1:
+        rest = 6
+    elif head[3] == 4:
+        rest = 18
+    else:
+        rest = (await asyncio.wait_for(read_upto(reader, 1), timeout=timeout) or b"\x00")[0] + 2
+    return len(await asyncio.wait_for(read_upto(reader, rest), timeout=timeout)) == rest
+
+async def _socks4_tunnel(reader, writer, host: str, port: int, timeout: float) -> bool:
+    reply = await exchange(reader, writer, socks4_request(host, port), 8, timeout)
+    return len(reply) == 8 and reply[0] == 0 and reply[1] == 0x5A
+
+async def _http_tunnel(reader, writer, host: str, port: int, timeout: float) -> bool:
+    writer.write(http_connect_request(host, port))
+    await writer.drain()
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=timeout)
+    return http_connect_ok(head)
+
+TUNNELS = {"socks5": _socks5_tunnel, "socks4": _socks4_tunnel, "http": _http_tunnel}
+
+_VERIFY_TLS_CTX: Optional[ssl.SSLContext] = None
+
+def _verify_tls_context() -> ssl.SSLContext:
+    """严格验证用的共享 SSLContext：校验证书链与主机名，确认隧道另一端确实是目标站点"""
+    global _VERIFY_TLS_CTX
+    if _VERIFY_TLS_CTX is None:
+        _VERIFY_TLS_CTX = ssl.create_default_context()
+    return _VERIFY_TLS_CTX
+
+async def verify_tunnel(n: Dict, target=None, timeout: float = SOCKS_GOOGLE_TIMEOUT) -> bool:
+    """
+    经 SOCKS5 / SOCKS4(a) / HTTP CONNECT 建立到 target 的隧道，再在隧道内验证目标：
+    端口 443 时以 SNI=host 做 TLS 握手并校验证书（多数 HTTP 代理只允许 CONNECT 443），否则发出 HEAD 请求。
+    成功时在节点上记录：_verify_hs_ms（代理握手至隧道建立）、_verify_tunnel_ms（隧道内 TLS 握手 / 首个 HTTP 应答）
+    """
+    tunnel = TUNNELS.get((n.get("type") or "").lower())
+    if tunnel is None:
+        return False
+    host, port = target or VERIFY_TARGET      # 调用时读取，便于测试 / 基准改写 VERIFY_TARGET
+    writer = None
+    try:
+        reader, writer = await open_conn(n["server"], n["port"], timeout)
+        t0 = time.perf_counter()
+        if not await tunnel(reader, writer, host, port, timeout):
+            STATS.error("verify", "tunnel_refused")
+            return False
+        t1 = time.perf_counter()
+        if int(port) == 443:
+            try:
+                await asyncio.wait_for(writer.start_tls(_verify_tls_context(), server_hostname=host), timeout=timeout)
+            except ssl.SSLError:
+                STATS.error("verify", "bad_tls")
+                return False
+        else:
+            req = f"HEAD / HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode()
+            if not (await exchange(reader, writer, req, 5, timeout)).startswith(b"HTTP/"):
+                STATS.error("verify", "bad_http")
+                return False
+        t2 = time.perf_counter()
+        n["_verify_hs_ms"] = round((t1 - t0) * 1000.0, 1)
+        n["_verify_tunnel_ms"] = round((t2 - t1) * 1000.0, 1)
+        return True
+    except Exception as e:
+        STATS.error("verify", type(e).__name__)
         return False
-    return False
+    finally:
+        if writer is not None:
+            await close_writer(writer)
+
+async def verify_all(nodes: List[Dict], target=None) -> List[Dict]:
+    """与 probe_candidates 相同的信号量模型；返回通过验证的节点（保持输入顺序）"""
+    sem = asyncio.Semaphore(CONCURRENCY)
+    async def one(n):
+        async with sem:
+            return await verify_tunnel(n, target)
+    with STATS.stage("verify"):
+        oks = await asyncio.gather(*(one(n) for n in nodes))
+    STATS.add("verify", items=len(nodes), ok=sum(oks))
+    return [n for n, ok in zip(nodes, oks) if ok]
 
 # ===================== 导出 & 订阅构建 =====================
 def to_clash_proxies(nodes: List[Dict]) -> List[Dict]:
-    return nodes
+    """去掉以 _ 开头的内部字段（测速/验证明细），其余原样输出"""
+    return [n.to_clash() if isinstance(n, Node) else {k: v for k, v in n.items() if not k.startswith("_")}
+            for n in nodes]
 
 # —— 生成“纯链接列表”（每行一个协议链接） ——
 def build_pure_link_list(nodes: List[Dict]) -> str:
@@ -517,19 +2202,55 @@ def build_pure_link_list(nodes: List[Dict]) -> str:
             links.append(lk)
     return "\n".join(links)
 
+def pack_links(nodes: List[Dict], budget: int) -> Tuple[List[List[Dict]], List[Dict]]:
+    """
+    按 to_proto_link() 的字节数把节点装箱成若干内嵌组：每组链接以换行连接后不超过 budget 字节。
+    按排序顺序做首次适应（first-fit）：每条链接放进第一个放得下的组，前面的组优先装满，
+    快节点仍集中在靠前的组。链接重复的节点随首次出现的组走，不占容量。
+    返回 (内嵌组列表, 无法内嵌的节点：无链接或单条链接即超出 budget)。
+    """
+    bins: List[List[Dict]] = []
+    free: List[int] = []           # 各组剩余字节（组内每条链接额外计 1 字节换行，组的首条多算的 1 字节预先补上）
+    placed: Dict[str, int] = {}
+    rest = []
+    for n in nodes:
+        lk = to_proto_link(n)
+        if lk in placed:
+            bins[placed[lk]].append(n)
+            continue
+        cost = len(lk.encode("utf-8")) + 1
+        if not lk or cost > budget + 1:
+            rest.append(n)
+            continue
+        for i, room in enumerate(free):
+            if cost <= room:
+                break
+        else:
+            i = len(bins)
+            bins.append([]); free.append(budget + 1)
+        bins[i].append(n)
+        free[i] -= cost
+        placed[lk] = i
+    return bins, rest
+
 # —— 生成批次文件 + 双二维码（URL蓝、内嵌绿） ——
 def export_batches(proto: str, nodes: List[Dict]) -> List[Dict]:
+    """
+    先按内嵌二维码容量装箱（pack_links），每组都能内嵌且尽量装满；
+    无法内嵌的节点再按 BATCH_SIZE 分批，只出 URL 型二维码，不做注定被拒的内嵌渲染。
+    """
     items = []
     if not nodes:
+        prune_batches(proto, 0)
         return items
     subdir = os.path.join(GROUPS_DIR, proto)
     os.makedirs(subdir, exist_ok=True)
-    for i in range(0, len(nodes), BATCH_SIZE):
-        batch = nodes[i:i+BATCH_SIZE]
-        idx = i // BATCH_SIZE + 1
+    bins, rest = pack_links(nodes, embed_raw_budget())
+    batches = [(b, True) for b in bins] + [(rest[i:i+BATCH_SIZE], False) for i in range(0, len(rest), BATCH_SIZE)]
+    for idx, (batch, embed) in enumerate(batches, 1):
         fn = f"{proto}_batch_{idx}.yaml"
         path = os.path.join(subdir, fn)
-        write_yaml(path, to_clash_proxies(batch))
+        write_yaml(path, batch)
         url_page = f"{SITE_BASE}/groups/{proto}/{fn}"
         url_raw  = f"{RAW_BASE}/groups/{proto}/{fn}"
 
@@ -537,36 +2258,54 @@ def export_batches(proto: str, nodes: List[Dict]) -> List[Dict]:
         qr_url_path = os.path.join(QRS_DIR, f"{proto}_batch_{idx}_url.png")
         save_qr_to(qr_url_path, url_page, color=(66,133,244))  # 蓝
 
-        # —— 纯链接列表内嵌二维码（绿）
+        # —— 纯链接列表内嵌二维码（绿）：装箱已保证容量，这里只渲染
         txt_links = build_pure_link_list(batch)
         txt_path = os.path.join(subdir, f"{proto}_batch_{idx}_links.txt")
         write_text(txt_path, txt_links)
 
-        data_bytes = txt_links.encode("utf-8")
-        data_uri = f"data:text/plain;base64,{base64.b64encode(data_bytes).decode('utf-8')}"
-        embed_ok = len(data_uri.encode("utf-8")) <= EMBED_MAX_BYTES
-
-        if embed_ok and txt_links.strip():
-            qr_emb_path = os.path.join(QRS_DIR, f"{proto}_batch_{idx}_embed.png")
+        qr_emb_path = os.path.join(QRS_DIR, f"{proto}_batch_{idx}_embed.png")
+        embed_bytes = data_uri_len(len(txt_links.encode("utf-8"))) if embed else 0
+        if embed:
+            data_uri = DATA_URI_PREFIX + base64.b64encode(txt_links.encode("utf-8")).decode("utf-8")
             save_qr_to(qr_emb_path, data_uri, color=(16,185,129))  # 绿
             embed_img_url = f"{SITE_BASE}/qrs/{proto}_batch_{idx}_embed.png"
         else:
+            if os.path.exists(qr_emb_path):        # 该编号之前是内嵌组，旧图不再被引用
+                os.remove(qr_emb_path)
+                _QR_RENDERED.pop(qr_emb_path, None)
             embed_img_url = None
 
         items.append({
             "index": idx,
+            "count": len(batch),
             "page_url": url_page,
             "raw_url": url_raw,
             "qr_url_img": f"{SITE_BASE}/qrs/{proto}_batch_{idx}_url.png",
             "qr_embed_img": embed_img_url,
-            "embed_fallback": (not embed_ok)
+            "embed_fallback": (not embed),
+            "embed_bytes": embed_bytes,
+            "qr_version": qr_version_for(embed_bytes) if embed else None,
         })
+    STATS.add("export", batches=len(items), embed_batches=len(bins), embed_bytes=sum(i["embed_bytes"] for i in items))
+    prune_batches(proto, len(items))
     return items
 
+def prune_batches(proto: str, keep: int):
+    """删除编号大于 keep 的旧批次文件（节点变少后残留的批次不再被页面引用）"""
+    pat = re.compile(rf"^{re.escape(proto)}_batch_(\d+)(?:\.yaml|_links\.txt|_url\.png|_embed\.png)$")
+    for d in (os.path.join(GROUPS_DIR, proto), QRS_DIR):
+        if not os.path.isdir(d):
+            continue
+        for fn in os.listdir(d):
+            m = pat.match(fn)
+            if m and int(m.group(1)) > keep:
+                os.remove(os.path.join(d, fn))
+                _QR_RENDERED.pop(os.path.join(d, fn), None)
+
 # —— “整包”订阅的双二维码（URL蓝 + 纯链接内嵌绿） ——
 def export_whole_proto(proto: str, nodes: List[Dict]) -> Dict:
     all_path = os.path.join(DOCS_DIR, f"{proto}.yaml")
-    write_yaml(all_path, to_clash_proxies(nodes))
+    write_yaml(all_path, nodes)
     url_page = f"{SITE_BASE}/{proto}.yaml"
     url_raw  = f"{RAW_BASE}/{proto}.yaml"
 
@@ -579,8 +2318,8 @@ def export_whole_proto(proto: str, nodes: List[Dict]) -> Dict:
     write_text(os.path.join(DOCS_DIR, f"{proto}_links.txt"), txt_links)
 
     data_bytes = txt_links.encode("utf-8")
-    data_uri = f"data:text/plain;base64,{base64.b64encode(data_bytes).decode('utf-8')}"
-    if txt_links.strip() and len(data_uri.encode("utf-8")) <= EMBED_MAX_BYTES:
+    if txt_links.strip() and data_uri_len(len(data_bytes)) <= embed_budget():
+        data_uri = DATA_URI_PREFIX + base64.b64encode(data_bytes).decode("utf-8")
         embed_qr_path = os.path.join(QRS_DIR, f"{proto}_all_embed.png")
         save_qr_to(embed_qr_path, data_uri, color=(16,185,129))
         embed_img = f"{SITE_BASE}/qrs/{proto}_all_embed.png"
@@ -602,7 +2341,7 @@ def export_single_fast_nodes(proto: str, nodes: List[Dict]) -> List[Dict]:
     out = []
     if not nodes:
         return out
-    fast = sorted(nodes, key=lambda x: x.get("delay", 9e9))[:TOPN_SINGLE_NODE_QR]
+    fast = nodes[:TOPN_SINGLE_NODE_QR]      # nodes 已按排行有序
     subdir = os.path.join(SINGLES_DIR, proto)
     os.makedirs(subdir, exist_ok=True)
     seen_links = set()
@@ -628,7 +2367,7 @@ def export_single_fast_nodes(proto: str, nodes: List[Dict]) -> List[Dict]:
 
 # —— 每协议“Top-5 紧凑列表”（黄） → 纯链接多行，内嵌二维码 ——
 def export_top5_bundle(proto: str, nodes: List[Dict]) -> Dict:
-    lst = sorted(nodes, key=lambda x: x.get("delay", 9e9))[:TOPN_YELLOW_BUNDLE]
+    lst = nodes[:TOPN_YELLOW_BUNDLE]        # nodes 已按排行有序
     links = []
     seen = set()
     for n in lst:
@@ -644,7 +2383,7 @@ def export_top5_bundle(proto: str, nodes: List[Dict]) -> Dict:
     txt_path = os.path.join(subdir, f"{proto}_top5_links.txt")
     write_text(txt_path, text)
 
-    data_uri = f"data:text/plain;base64,{base64.b64encode(text.encode('utf-8')).decode('utf-8')}"
+    data_uri = DATA_URI_PREFIX + base64.b64encode(text.encode("utf-8")).decode("utf-8")
     qr_path = os.path.join(QRS_DIR, f"{proto}_top5_embed.png")
     save_qr_to(qr_path, data_uri, color=YELLOW_QR_COLOR)
     return {
@@ -669,6 +2408,11 @@ def build_index_html(summary: Dict,
   <div class="item">平均延迟(ms)：<b>{summary.get('avg_delay',0)}</b></div>
 </div>"""
 
+    # 与 verify_tunnel 一致：443 时在隧道内做带证书校验的 TLS 握手，其他端口发 HEAD
+    v_host, v_port = VERIFY_TARGET
+    verify_desc = (f"代理内 CONNECT {v_host}:{v_port} 并完成 TLS 握手（SNI + 证书校验）" if v_port == 443
+                   else f"代理内连 {v_host}:{v_port} 并发送 HEAD 请求")
+
     html = f"""<!doctype html>
 <html lang="zh-CN">
 <head>
@@ -763,7 +2507,7 @@ hr.sep{{border:0;border-top:1px dashed #263043;margin:8px 0}}
   </div>
 
   <div class="card">
-    <h3 class="section-title">按协议分批订阅（每批 20 个，推荐）<span class="badge blue">URL</span> <span class="badge green">纯链接内嵌</span></h3>
+    <h3 class="section-title">按协议分批订阅（按内嵌二维码容量装箱，推荐）<span class="badge blue">URL</span> <span class="badge green">纯链接内嵌</span></h3>
 """
     for proto, batches in per_proto_batches.items():
         if not batches:
@@ -774,7 +2518,7 @@ hr.sep{{border:0;border-top:1px dashed #263043;margin:8px 0}}
             txt_url = b["page_url"].replace(".yaml","_links.txt")
             html += f"""
           <div class="card">
-            <div><b>批次 #{b['index']}</b></div>
+            <div><b>批次 #{b['index']}</b>{f"（{b['count']} 个）" if b.get('count') else ""}</div>
             <div class="row">
               <a class="tag" href="{b['page_url']}" target="_blank">YAML（页面）</a>
               <a class="tag" href="{b['raw_url']}" target="_blank">YAML（Raw）</a>
@@ -846,7 +2590,7 @@ hr.sep{{border:0;border-top:1px dashed #263043;margin:8px 0}}
     <h3>说明</h3>
     <div class="small">
     1) 节点来自公开免费源，先并发 TCP 存活筛选，再按每协议保留前 {KEEP_TOP_PER_TYPE} 个。<br/>
-    2) “中国大陆可用”仅对 SOCKS/HTTP 做了 <code>代理内连 Google.com:80</code> 的快速校验，SS/VMess/Trojan/VLESS 未做真实 HTTP 验证。<br/>
+    2) “中国大陆可用”仅对 SOCKS/HTTP 做了 <code>{verify_desc}</code> 的快速校验，SS/VMess/Trojan/VLESS 未做真实 HTTP 验证。<br/>
     3) 二维码：蓝边=URL 型（最稳），绿边=内嵌型（纯链接列表，离线导入，容量有限，超限自动回退），紫边=单节点（最大兼容），黄边=Top-5 紧凑列表（极小，成功率高）。<br/>
     4) 若扫码“无效”，请使用系统相机/浏览器扫码“打开链接”再交由客户端导入（部分客户端只识别 URL 型）。<br/>
     更新时间：{summary.get('updated','')}
@@ -859,30 +2603,460 @@ hr.sep{{border:0;border-top:1px dashed #263043;margin:8px 0}}
     return html
 
 # ===================== 主流程 =====================
-def main():
-    print("开始抓取源…")
-    nodes = collect_nodes()
-    collected = len(nodes)
-
-    print("并发 TCP 测速…")
-    loop = asyncio.new_event_loop()
+# ===================== 性能剖析（--profile，关闭时零开销） =====================
+PROFILE_STAGES = ("collect_nodes", "run_pipeline", "probe_candidates", "resample_top", "app_probe_all",
+                  "verify_all", "export_whole_proto", "export_batches", "export_single_fast_nodes",
+                  "export_top5_bundle", "make_qr_img", "write_yaml", "build_index_html")
+PROFILE_TOP = 30             # 合并热点摘要显示的函数数
+
+class StageProfiler:
+    """
+    按阶段累积 cProfile：启用时替换模块内同名函数为包装函数（main 按名调用即生效）。
+    同一时刻只有一个 Profile 处于启用状态：嵌套阶段（如 export_batches 内的 make_qr_img）
+    进入时暂停外层、退出时恢复，各阶段的 pstats 互不重叠。
+    """
+    def __init__(self, out_dir: str, tasks: bool = False):
+        import cProfile
+        self.out_dir = out_dir
+        self.profiles = {name: cProfile.Profile() for name in PROFILE_STAGES}
+        self.seconds = collections.Counter()
+        self.calls = collections.Counter()
+        self.stack: List[str] = []
+        self.tasks = TaskTimer() if tasks else None
+
+    def _enter(self, name: str):
+        if self.stack:
+            self.profiles[self.stack[-1]].disable()
+        self.stack.append(name)
+        self.profiles[name].enable()
+
+    def _exit(self, name: str):
+        self.profiles[name].disable()
+        self.stack.pop()
+        if self.stack:
+            self.profiles[self.stack[-1]].enable()
+
+    def wrap(self, name: str, fn):
+        if asyncio.iscoroutinefunction(fn):
+            async def wrapped(*a, **k):
+                t = time.perf_counter(); self._enter(name)
+                try:
+                    return await fn(*a, **k)
+                finally:
+                    self._exit(name); self.seconds[name] += time.perf_counter() - t; self.calls[name] += 1
+        else:
+            def wrapped(*a, **k):
+                t = time.perf_counter(); self._enter(name)
+                try:
+                    return fn(*a, **k)
+                finally:
+                    self._exit(name); self.seconds[name] += time.perf_counter() - t; self.calls[name] += 1
+        wrapped.__wrapped__ = fn
+        return wrapped
+
+    def install(self):
+        g = globals()
+        for name in PROFILE_STAGES:
+            g[name] = self.wrap(name, g[name])
+        if self.tasks is not None:
+            orig = g["new_event_loop"]
+            def new_loop():
+                loop = orig()
+                loop.set_task_factory(self.tasks.factory)
+                return loop
+            g["new_event_loop"] = new_loop
+
+    def dump(self, top: int = PROFILE_TOP) -> str:
+        """写出 <阶段>.pstats（仅有调用的阶段）与 summary.txt；返回摘要文本"""
+        import io
+        import pstats
+        os.makedirs(self.out_dir, exist_ok=True)
+        files = []
+        for name, prof in self.profiles.items():
+            if not self.calls[name]:
+                continue
+            path = os.path.join(self.out_dir, f"{name}.pstats")
+            prof.dump_stats(path)
+            files.append(path)
+        buf = io.StringIO()
+        buf.write(f"{'阶段':<26}{'调用':>6}{'秒':>10}  （wall，含嵌套阶段）\n")
+        for name, sec in self.seconds.most_common():
+            buf.write(f"{name:<26}{self.calls[name]:>6}{sec:>10.3f}\n")
+        if files:
+            st = pstats.Stats(*files, stream=buf)
+            st.files = []        # 不逐个打印文件头
+            st.strip_dirs().sort_stats("tottime")
+            buf.write(f"\n== 合并热点（按 tottime，前 {top}） ==\n")
+            st.print_stats(top)
+            st.sort_stats("cumulative")
+            buf.write(f"\n== 合并热点（按 cumulative，前 {top}） ==\n")
+            st.print_stats(top)
+        if self.tasks is not None:
+            buf.write("\n== asyncio 任务（按协程名汇总） ==\n")
+            buf.write(self.tasks.table(top))
+            write_text(os.path.join(self.out_dir, "tasks.json"),
+                       json.dumps(self.tasks.report(), ensure_ascii=False, indent=2))
+        text = buf.getvalue()
+        write_text(os.path.join(self.out_dir, "summary.txt"), text)
+        return text
+
+class _TimedCoro(collections.abc.Coroutine):
+    """包装协程：累计每次 send/throw 在事件循环中的执行时间（on-CPU），结束时记入 TaskTimer"""
+    __slots__ = ("_coro", "_timer", "_name", "_created", "_busy", "_steps")
+
+    def __init__(self, coro, timer, name: str):
+        self._coro, self._timer, self._name = coro, timer, name
+        self._created = time.perf_counter()
+        self._busy = 0.0
+        self._steps = 0
+
+    def send(self, value):
+        t = time.perf_counter()
+        try:
+            return self._coro.send(value)
+        except BaseException:
+            self._finish(t)
+            raise
+        finally:
+            self._busy += time.perf_counter() - t
+            self._steps += 1
+
+    def throw(self, *args):
+        t = time.perf_counter()
+        try:
+            return self._coro.throw(*args)
+        except BaseException:
+            self._finish(t)
+            raise
+        finally:
+            self._busy += time.perf_counter() - t
+            self._steps += 1
+
+    def close(self):
+        return self._coro.close()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def _finish(self, t: float):
+        end = time.perf_counter()
+        self._timer.record(self._name, end - self._created, self._busy + (end - t), self._steps + 1)
+
+class TaskTimer:
+    """asyncio 任务级计时：按协程 __qualname__ 汇总次数、总/最大存活时间（wall）与事件循环内执行时间（busy）"""
+    def __init__(self):
+        self.rows: Dict[str, List[float]] = {}   # name → [n, wall, wall_max, busy, busy_max, steps]
+
+    def factory(self, loop, coro, **kw):
+        name = getattr(coro, "__qualname__", type(coro).__name__)
+        return asyncio.Task(_TimedCoro(coro, self, name), loop=loop, **kw)
+
+    def record(self, name: str, wall: float, busy: float, steps: int):
+        r = self.rows.setdefault(name, [0, 0.0, 0.0, 0.0, 0.0, 0])
+        r[0] += 1; r[1] += wall; r[2] = max(r[2], wall)
+        r[3] += busy; r[4] = max(r[4], busy); r[5] += steps
+
+    def report(self) -> Dict[str, Dict]:
+        return {name: {"tasks": r[0], "wall": round(r[1], 4), "wall_max": round(r[2], 4),
+                       "busy": round(r[3], 4), "busy_max": round(r[4], 4), "steps": r[5]}
+                for name, r in self.rows.items()}
+
+    def table(self, top: int) -> str:
+        rows = sorted(self.rows.items(), key=lambda kv: -kv[1][3])[:top]
+        out = [f"{'协程':<40}{'任务数':>8}{'wall(s)':>10}{'wall_max':>10}{'busy(s)':>10}{'busy_max':>10}{'steps':>8}"]
+        for name, r in rows:
+            out.append(f"{name[-40:]:<40}{r[0]:>8}{r[1]:>10.3f}{r[2]:>10.3f}{r[3]:>10.4f}{r[4]:>10.4f}{r[5]:>8}")
+        return "\n".join(out) + "\n"
+
+# ===================== 分阶段运行 & 中间快照（JSONL） =====================
+PIPELINE_STAGES = ("fetch", "probe", "verify", "export", "page")
+SNAP_DIR = os.path.join(CACHE_DIR, "snap")  # 各阶段输出：<名称>.jsonl，首行为 {"meta": …}，其后每行一条记录
+
+def _snap_path(name: str, snap_dir: str = None) -> str:
+    return os.path.join(snap_dir or SNAP_DIR, f"{name}.jsonl")
+
+def write_snapshot(name: str, rows, meta: Dict = None, snap_dir: str = None) -> str:
+    """流式写出快照（先写临时文件再原子替换，中途失败不会留下半个快照）"""
+    path = _snap_path(name, snap_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    n = 0
+    with STATS.stage("snapshot"), open(tmp, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"meta": meta or {}}, ensure_ascii=False, default=json_default) + "\n")
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False, separators=(",", ":"), default=json_default) + "\n")
+            n += 1
+        STATS.add("snapshot", items=n, bytes=f.tell())
+    os.replace(tmp, path)
+    print(f"[Snapshot] {name}: {n} 条 → {path}")
+    return path
+
+def read_snapshot(name: str, snap_dir: str = None) -> Tuple[Dict, List[Dict]]:
+    """读取快照，返回 (meta, 记录列表)；不存在时抛出 FileNotFoundError 并提示先运行的阶段"""
+    path = _snap_path(name, snap_dir)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"缺少快照 {path}，请先运行产出它的阶段（--stages {SNAP_PRODUCER[name]}）")
+    return _read_jsonl(path)
+
+def _read_jsonl(path: str) -> Tuple[Dict, List[Dict]]:
+    with open(path, "r", encoding="utf-8") as f:
+        meta = json.loads(f.readline() or "{}").get("meta", {})
+        rows = [json.loads(line) for line in f if line.strip()]
+    return meta, rows
+
+SNAP_PRODUCER = {"candidates": "fetch", "probed": "probe", "verified": "verify", "exported": "export"}
+
+def _group_by_type(nodes: List[Dict]) -> Dict[str, List[Dict]]:
+    by_type: Dict[str, List[Dict]] = {}
+    for n in nodes:
+        by_type.setdefault((n.get("type") or "").lower(), []).append(n)
+    return by_type
+
+# —— 分片测速：本机多进程（--shards N）或多机各跑一片（--shard I/N），结果文件用 --merge 合并 ——
+SHARD_DIR = os.path.join(SNAP_DIR, "shards")  # 分片结果：probed-<i>-of-<n>.jsonl，格式同 probed 快照，meta 含测速日志
+
+def shard_of(n: Dict, shards: int) -> int:
+    """按 (server, port) 的 crc32 分片：跨进程 / 跨机器稳定（不受 PYTHONHASHSEED 影响）"""
+    return zlib.crc32(f"{n['server']}:{n['port']}".encode()) % shards
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """'I/N' → (I, N)，0 <= I < N"""
+    i, _, n = spec.partition("/")
+    shard, shards = int(i), int(n)
+    if not 0 <= shard < shards:
+        raise ValueError(f"分片编号越界：{spec}")
+    return shard, shards
+
+class HealthLog:
+    """分片进程内代替 HealthDB：不做过滤，只记下 键 → 延迟（失败为 None），合并时回放进健康库"""
+
+    def __init__(self):
+        self.log: Dict[str, Optional[float]] = {}
+
+    def order(self, nodes: List[Dict]) -> List[Dict]:
+        return nodes
+
+    def record(self, n: Dict, delay):
+        self.log[HealthDB.key(n)] = delay
+
+def probe_shard(nodes: List[Dict], shard: int, shards: int, out_dir: str = None,
+                backend: str = None) -> str:
+    """在当前进程用独立事件循环测速一个分片，写出 probed-<i>-of-<n>.jsonl 并返回路径"""
+    global RESOLVER, LATENCY
+    RESOLVER, LATENCY = Resolver(), LatencyTracker()   # 子进程不沿用父进程的解析线程池与延迟样本
+    loop = new_event_loop()
     asyncio.set_event_loop(loop)
-    tested = loop.run_until_complete(test_all_tcp(nodes))
+    log = HealthLog()
+    t0 = time.perf_counter()
+    try:
+        ranking = loop.run_until_complete(probe_candidates(nodes, log, backend))
+    finally:
+        loop.close()
+    rows = [n for lst in ranking.by_type().values() for n in lst]
+    meta = {"shard": shard, "shards": shards, "candidates": len(nodes), "alive": len(rows),
+            "seconds": round(time.perf_counter() - t0, 2), "host": socket.gethostname(),
+            "updated": now_str_beijing(), "concurrency": RUN_REPORT.get("concurrency"),
+            "latency": {"timeout": round(LATENCY.timeout, 3), "samples": len(LATENCY.samples)},
+            "dns": RESOLVER.stats(), "stats": STATS.snapshot()["stages"].get("probe"), "health": log.log}
+    return write_snapshot(f"probed-{shard}-of-{shards}", rows, meta, out_dir or SHARD_DIR)
+
+def probe_sharded(nodes: List[Dict], shards: int, out_dir: str = None,
+                  backend: str = None) -> List[str]:
+    """
+    本机按 shard_of 切分候选，每片一个新进程，返回各分片文件路径。
+    用 spawn 启动：此时抓取线程可能仍在收尾，fork 多线程进程不安全；每个进程只跑一片，
+    分片元数据里的 STATS 不会混入上一片的计数。
+    """
+    parts: List[List[Dict]] = [[] for _ in range(shards)]
+    for n in nodes:
+        parts[shard_of(n, shards)].append(n)
+    print(f"[Shard] {shards} 个进程，每片候选 {[len(p) for p in parts]}")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=shards, mp_context=multiprocessing.get_context("spawn"),
+                                                max_tasks_per_child=1) as pool:
+        futs = [pool.submit(probe_shard, part, i, shards, out_dir, backend) for i, part in enumerate(parts)]
+        return [f.result() for f in futs]
+
+def shard_files(paths: List[str]) -> List[str]:
+    """展开 --merge 参数：目录取其中全部 probed-*-of-*.jsonl"""
+    out = []
+    for p in paths:
+        if os.path.isdir(p):
+            out += sorted(os.path.join(p, f) for f in os.listdir(p)
+                          if re.fullmatch(r"probed-\d+-of-\d+\.jsonl", f))
+        else:
+            out.append(p)
+    return out
 
-    # 各协议分组 & 截断
-    by_type: Dict[str, List[Dict]] = {}
-    for n in tested:
-        t = (n.get("type") or "").lower()
-        by_type.setdefault(t, []).append(n)
-    for t, lst in by_type.items():
-        by_type[t] = sorted(lst, key=lambda x: x.get("delay", 9e9))[:KEEP_TOP_PER_TYPE]
+def merge_shards(paths: List[str], health: HealthDB = None) -> Tuple[int, Ranking]:
+    """
+    合并分片结果为一个 Ranking：所有记录按 (排序值, type, server, port) 排好再依次入堆，
+    结果与文件顺序、分片数无关（同样的测速结果得到同样的排行）。返回 (候选总数, 排行)。
+    """
+    metas, nodes = [], []
+    for p in shard_files(paths):
+        meta, rows = _read_jsonl(p)
+        metas.append(meta)
+        nodes += (as_node(d) for d in rows)
+    if not metas:
+        raise FileNotFoundError(f"没有可合并的分片文件：{paths}")
+    counts = {m.get("shards") for m in metas}
+    if len(counts) != 1:
+        raise ValueError(f"分片文件的分片数不一致：{sorted(counts, key=str)}")
+    shards = counts.pop()
+    seen = [m.get("shard") for m in metas]
+    dup = sorted({i for i in seen if seen.count(i) > 1})
+    if dup:
+        raise ValueError(f"分片重复：{dup}")
+    missing = sorted(set(range(shards or 0)) - set(seen))
+    if missing:
+        print(f"[Shard] 警告：缺少分片 {missing}/{shards}，按已有分片合并")
+
+    nodes.sort(key=lambda n: (rank_value(n), n.get("type") or "", str(n["server"]), n["port"]))
+    ranking = Ranking()
+    for n in nodes:
+        ranking.push(n)
+    if health is not None:
+        for m in metas:
+            for key, delay in (m.get("health") or {}).items():
+                health.record_key(key, delay)
+    collected = sum(m.get("candidates", 0) for m in metas)
+    RUN_REPORT["shards"] = [{k: m.get(k) for k in ("shard", "host", "candidates", "alive", "seconds",
+                                                    "concurrency", "latency", "dns", "stats")}
+                            for m in sorted(metas, key=lambda m: m.get("shard", 0))]
+    # 后续多次采样 / 应用层测速在合并方进行，沿用各分片自适应超时中最宽松者
+    timeouts = [m["latency"]["timeout"] for m in metas if m.get("latency")]
+    if timeouts:
+        LATENCY.timeout = max(timeouts)
+    print(f"[Shard] 合并 {len(metas)}/{shards} 个分片：候选 {collected}，存活 {len(nodes)}，"
+          f"最慢分片 {max(m.get('seconds', 0) for m in metas):.1f}s")
+    return collected, ranking
+
+def stage_fetch(ctx: Dict):
+    """抓取 + 解析 + 去重 → candidates 快照（不测速）"""
+    print("开始抓取源…")
+    nodes = collect_nodes()
+    ctx["collected"] = len(nodes)
+    write_snapshot("candidates", nodes, {"collected": len(nodes), "sources": len(SOURCES)}, ctx["snap_dir"])
+
+def _load_candidates(ctx: Dict) -> Tuple[int, List[Dict]]:
+    meta, cands = read_snapshot("candidates", ctx["snap_dir"])
+    cands = [as_node(d) for d in cands]
+    return meta.get("collected", len(cands)), cands
+
+def stage_probe(ctx: Dict):
+    """
+    测速 → probed 快照（每协议 Top-K，按排序值有序，含 _ 开头的测速明细）。
+    与 fetch 同批运行时走流式流水线（抓取即测速），否则读取 candidates 快照；
+    --shards N 时按分片多进程测速再合并，--shard I/N 只测一片并写出分片文件即停止，
+    --merge 则直接合并已有分片文件（可来自多台机器）。
+    """
+    loop = ctx["loop"]
+    health = HealthDB() if HEALTH_ENABLED else None
+    sharded = False
+    if ctx.get("merge"):
+        collected, ranking = merge_shards(ctx["merge"], health)
+        sharded = True
+    elif ctx.get("shard"):
+        shard, shards = ctx["shard"]
+        _, cands = _load_candidates(ctx)
+        if health is not None:
+            cands = health.order(cands)       # 只借用退避过滤，健康库由合并方统一写入
+        cands = [n for n in cands if shard_of(n, shards) == shard]
+        print(f"TCP 测速（分片 {shard}/{shards}，候选 {len(cands)} 条）…")
+        probe_shard(cands, shard, shards, ctx.get("shard_dir"), ctx.get("backend"))
+        ctx["halt"] = True
+        return
+    elif ctx.get("shards", 1) > 1:
+        collected, cands = _load_candidates(ctx)
+        if health is not None:
+            cands = health.order(cands)
+        print(f"TCP 测速（candidates 快照 {len(cands)} 条，分 {ctx['shards']} 片）…")
+        paths = probe_sharded(cands, ctx["shards"], ctx.get("shard_dir"), ctx.get("backend"))
+        del cands
+        _, ranking = merge_shards(paths, health)
+        sharded = True
+    elif ctx.get("fused_fetch"):
+        print("开始抓取源（流式解析 + 并发 TCP 测速）…")
+        cands: List[Dict] = []
+        collected, ranking = loop.run_until_complete(run_pipeline(SOURCES, health, sink=cands, backend=ctx.get("backend")))
+        write_snapshot("candidates", cands, {"collected": collected, "sources": len(SOURCES)}, ctx["snap_dir"])
+        del cands
+    else:
+        collected, cands = _load_candidates(ctx)
+        print(f"TCP 测速（candidates 快照 {len(cands)} 条）…")
+        ranking = loop.run_until_complete(probe_candidates(cands, health, ctx.get("backend")))
+    by_type = ranking.by_type()
+    if health is not None:
+        health.save()
+
+    if sharded:
+        # 测速发生在各分片进程里：DNS / 并发统计随分片记录在 RUN_REPORT["shards"]，超时取各分片最宽松者
+        for rec in RUN_REPORT["shards"]:
+            print(f"[Shard] #{rec['shard']} {rec['host']}：候选 {rec['candidates']}，存活 {rec['alive']}，{rec['seconds']}s")
+    else:
+        dns = RUN_REPORT["dns"] = RESOLVER.stats()
+        print(f"[DNS] {dns['backend']}：查询 {dns['queries']}，实际解析 {dns['lookups']}，命中率 {dns['hit_rate']:.1%}，"
+              f"失败 {dns['failures']}，平均解析 {dns['avg_lookup_ms']}ms")
+        conc = RUN_REPORT.get("concurrency", {})
+        print(f"[Concurrency] fd 预算 {conc.get('fd_budget')}，峰值 {conc.get('peak')}，最终 {conc.get('final')}，"
+              f"轨迹 {conc.get('history', [])[-12:]}")
+        print(f"[Latency] 自适应 TCP 超时 {LATENCY.timeout:.2f}s（样本 {len(LATENCY.samples)}）")
+        RUN_REPORT["latency"] = {"timeout": round(LATENCY.timeout, 3), "samples": len(LATENCY.samples)}
+    if SAMPLE_COUNT > 1:
+        print(f"多次采样（每节点 {SAMPLE_COUNT} 次）…")
+        with STATS.stage("sample"):
+            sampled = loop.run_until_complete(resample_top(by_type, ctx.get("backend")))
+        STATS.add("sample", items=sampled)
+        print(f"[Sample] 采样节点 {sampled}")
+
+    if APP_PROBE:
+        print("应用层测速（TLS / ws）…")
+        with STATS.stage("app_probe"):
+            ok = loop.run_until_complete(app_probe_all(by_type))
+        STATS.add("app_probe", ok=ok)
+        print(f"[AppProbe] 通过 {ok}")
+
+    # 排序值已变化（采样 / 应用层），重排后按协议取有序切片
+    ranking.rerank()
+    ctx["by_type"] = ranking.by_type()
+    ctx["collected"] = collected
+    write_snapshot("probed", (n for lst in ctx["by_type"].values() for n in lst),
+                   {"collected": collected, "updated": now_str_beijing()}, ctx["snap_dir"])
+
+def _load_probed(ctx: Dict):
+    if "by_type" not in ctx:
+        meta, nodes = read_snapshot("probed", ctx["snap_dir"])
+        nodes = [as_node(d) for d in nodes]
+        ctx["by_type"] = _group_by_type(nodes)
+        ctx["collected"] = meta.get("collected", 0)
+        print(f"[Snapshot] 载入 probed：{len(nodes)} 条")
+
+def stage_verify(ctx: Dict):
+    """SOCKS/HTTP 严格 Google 验证 → verified 快照"""
+    _load_probed(ctx)
+    by_type = ctx["by_type"]
+    google_ok = []
+    if STRICT_CN_GOOGLE:
+        print("执行 SOCKS/HTTP Google 严格验证…")
+        cand = by_type.get("socks4", []) + by_type.get("socks5", []) + by_type.get("http", [])
+        google_ok = ctx["loop"].run_until_complete(verify_all(cand))
+    ctx["google_ok"] = google_ok
+    write_snapshot("verified", google_ok, {"updated": now_str_beijing()}, ctx["snap_dir"])
 
-    tcp_ok_nodes = [x for lst in by_type.values() for x in lst]
-    avg_ms = avg_delay([n.get("delay",0) for n in tcp_ok_nodes])
+EXPORT_PROTOS = ("ss","vmess","trojan","vless","socks4","socks5","http")
 
+def export_subscriptions(tcp_ok_nodes: List[Dict], google_ok: Optional[List[Dict]]):
+    """主订阅 proxy.yaml / sub / proxy_all.yaml 与二维码；google_ok 非 None 时另写 proxy_cn_google.yaml"""
     # —— 主订阅（全部 TCP 可用）
     proxy_yaml_path = os.path.join(DOCS_DIR, "proxy.yaml")
-    write_yaml(proxy_yaml_path, to_clash_proxies(tcp_ok_nodes))
+    proxies = to_clash_proxies(tcp_ok_nodes)
+    write_yaml(proxy_yaml_path, proxies)
     with open(proxy_yaml_path, "rb") as f:
         yb = f.read()
     write_base64_sub(os.path.join(DOCS_DIR, "sub"), yb)
@@ -890,61 +3064,812 @@ def main():
     save_qr_to(os.path.join(DOCS_DIR, "qrcode_main.png"), f"{SITE_BASE}/sub", color=(66,133,244))
 
     # —— 中国大陆可用（SOCKS/HTTP 严格 Google）
-    google_ok = []
-    if STRICT_CN_GOOGLE:
-        print("执行 SOCKS/HTTP Google 严格验证…")
-        for n in by_type.get("socks4", []) + by_type.get("socks5", []) + by_type.get("http", []):
-            if google_via_socks_http(n):
-                google_ok.append(n)
+    if google_ok is not None:
         path_cn = os.path.join(DOCS_DIR, "proxy_cn_google.yaml")
-        write_yaml(path_cn, to_clash_proxies(google_ok))
+        write_yaml(path_cn, google_ok)
         save_qr_to(os.path.join(DOCS_DIR, "qrcode_cn_google.png"),
                    f"{SITE_BASE}/proxy_cn_google.yaml", color=(66,133,244))
 
-    # —— 导出各协议“整包” + 双二维码（URL + 纯链接内嵌）
-    per_proto_all_cards = []
-    for proto in ("ss","vmess","trojan","vless","socks4","socks5","http"):
-        lst = by_type.get(proto, [])
-        card = export_whole_proto(proto, lst)
-        per_proto_all_cards.append(card)
-
-    # —— 按协议分批导出 + 双二维码
-    per_proto_batches = {}
-    for proto in ("ss","vmess","trojan","vless","socks4","socks5","http"):
-        per_proto_batches[proto] = export_batches(proto, by_type.get(proto, []))
-
-    # —— 每协议“单节点二维码”（紫）
-    per_proto_singles = {}
-    for proto in ("ss","vmess","trojan","vless","socks4","socks5","http"):
-        per_proto_singles[proto] = export_single_fast_nodes(proto, by_type.get(proto, []))
-
-    # —— 每协议 Top-5 紧凑列表（黄）
-    per_proto_top5 = {}
-    for proto in ("ss","vmess","trojan","vless","socks4","socks5","http"):
-        info = export_top5_bundle(proto, by_type.get(proto, []))
-        per_proto_top5[proto] = info if info else {}
-
-    # —— 另存一份 proxy_all.yaml（别名）
-    write_yaml(os.path.join(DOCS_DIR, "proxy_all.yaml"), to_clash_proxies(tcp_ok_nodes))
-
-    # —— 页面
+    # —— 另存一份 proxy_all.yaml（别名，内容与 proxy.yaml 相同）
+    with open(os.path.join(DOCS_DIR, "proxy_all.yaml"), "wb") as f:
+        f.write(yb)
+
+    # —— 增量 + 预压缩版本 + manifest.json
+    write_manifest(proxies)
+
+# —— 增量订阅 & 预压缩：manifest.json 给出当前版本、各文件大小 / 摘要 / 压缩版本与可用增量 ——
+def _brotli():
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+def compress_file(path: str, prev: Dict = None) -> Dict:
+    """
+    写 <path>.gz（mtime=0，内容不变则字节不变）与可用时的 <path>.br，返回 manifest 条目。
+    prev 为上一版 manifest 中该文件的条目：摘要相同且压缩文件都在时跳过重新压缩。
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    entry = {"size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+    if len(data) < COMPRESS_MIN:
+        return entry
+    br = _brotli()
+    variants = {"gz": lambda b: gzip.compress(b, compresslevel=9, mtime=0)}
+    if br is not None:
+        variants["br"] = lambda b: br.compress(b, quality=11)
+    with STATS.stage("compress"):
+        for ext, fn in variants.items():
+            out = f"{path}.{ext}"
+            if prev and prev.get("sha256") == entry["sha256"] and ext in prev and os.path.exists(out):
+                entry[ext] = prev[ext]
+                STATS.add("compress", skipped=1)
+                continue
+            blob = fn(data)
+            with open(out, "wb") as f:
+                f.write(blob)
+            entry[ext] = len(blob)
+            STATS.add("compress", items=1, bytes=len(data), out_bytes=len(blob))
+    return entry
+
+def node_digest(p: Dict) -> str:
+    """Clash 条目去掉 DELTA_IGNORE 字段后的摘要（判断同一键的节点是否变化）"""
+    body = {k: v for k, v in p.items() if k not in DELTA_IGNORE}
+    return hashlib.sha1(json.dumps(body, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()[:16]
+
+def _load_json(path: str, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return default
+
+def write_delta(proxies: List[Dict]) -> Dict:
+    """
+    与上一版本（delta/state.json：版本号 + 键 → 摘要）比较，键为 type|server|port：
+    有变化时版本号 +1，写 delta/<旧>-<新>.json（added / changed 为完整 Clash 条目，removed 为键）。
+    客户端按 manifest.deltas 依次应用即可追上当前版本；节点顺序以全量文件为准。
+    返回 manifest 的版本相关字段。
+    """
+    os.makedirs(DELTA_DIR, exist_ok=True)
+    state_path = os.path.join(DELTA_DIR, "state.json")
+    state = _load_json(state_path, {})
+    prev_nodes: Dict[str, str] = state.get("nodes", {})
+    cur = {HealthDB.key(p): p for p in proxies}
+    digests = {k: node_digest(p) for k, p in cur.items()}
+    version = state.get("version", 0)
+    epoch = state.get("epoch") or now_str_beijing()
+    deltas = _load_json(MANIFEST_PATH, {}).get("deltas", []) if version else []
+
+    added = [k for k in cur if k not in prev_nodes]
+    changed = [k for k in cur if k in prev_nodes and prev_nodes[k] != digests[k]]
+    removed = [k for k in prev_nodes if k not in cur]
+    if not version or added or changed or removed:
+        version += 1
+        if version > 1:
+            name = f"{version - 1}-{version}.json"
+            path = os.path.join(DELTA_DIR, name)
+            write_text(path, json.dumps({"from": version - 1, "to": version,
+                                         "added": [cur[k] for k in added], "changed": [cur[k] for k in changed],
+                                         "removed": removed}, ensure_ascii=False, separators=(",", ":")))
+            entry = compress_file(path)
+            entry.update({"from": version - 1, "to": version, "path": f"delta/{name}",
+                          "added": len(added), "changed": len(changed), "removed": len(removed)})
+            deltas.append(entry)
+        state = {"version": version, "epoch": epoch, "nodes": digests}
+        write_text(state_path, json.dumps(state, separators=(",", ":")))
+        print(f"[Delta] 版本 {version}：新增 {len(added)}，变化 {len(changed)}，删除 {len(removed)}")
+
+    keep = deltas[-DELTA_KEEP:]
+    live = {os.path.basename(d["path"]) for d in keep}
+    for f in os.listdir(DELTA_DIR):
+        if f != "state.json" and f.split(".json")[0] + ".json" not in live:
+            os.remove(os.path.join(DELTA_DIR, f))
+    return {"version": version, "epoch": epoch, "count": len(cur), "key": "type|server|port", "deltas": keep}
+
+def write_manifest(proxies: List[Dict]):
+    """manifest.json：当前版本 / 全量文件（大小、sha256、压缩版本大小）/ 可用增量"""
+    prev = _load_json(MANIFEST_PATH, {}).get("files", {})
+    manifest = {"updated": now_str_beijing()}
+    if DELTA_ENABLED:
+        manifest.update(write_delta(proxies))
+    manifest["files"] = {name: compress_file(os.path.join(DOCS_DIR, name), prev.get(name))
+                         for name in COMPRESS_FILES if os.path.exists(os.path.join(DOCS_DIR, name))}
+    write_text(MANIFEST_PATH, json.dumps(manifest, ensure_ascii=False, indent=1))
+
+def export_proto(proto: str, nodes: List[Dict]) -> Dict:
+    """单个协议的全部导出：整包 + 双二维码、分批（EXPORT_BATCHES）、单节点二维码（紫）、Top-5 紧凑列表（黄）"""
+    with STATS.stage("export"):
+        if EXPORT_BATCHES:
+            batches = export_batches(proto, nodes)
+        else:
+            prune_batches(proto, 0)
+            batches = []
+        return {
+            "proto": proto,
+            "card": export_whole_proto(proto, nodes),
+            "batches": batches,
+            "singles": export_single_fast_nodes(proto, nodes),
+            "top5": export_top5_bundle(proto, nodes) or {},
+        }
+
+def page_cards(exported: List[Dict]) -> Tuple[List[Dict], Dict, Dict, Dict]:
+    """export_proto 结果列表 → build_index_html 的四组卡片参数"""
+    return ([r["card"] for r in exported], {r["proto"]: r["batches"] for r in exported},
+            {r["proto"]: r["singles"] for r in exported}, {r["proto"]: r["top5"] for r in exported})
+
+def stage_export(ctx: Dict):
+    """订阅 YAML / Base64 / 二维码 / 各协议整包、批次、单节点、Top-5 → exported 快照（页面所需卡片数据）"""
+    _load_probed(ctx)
+    by_type = ctx["by_type"]
+    if "google_ok" not in ctx:
+        try:
+            ctx["google_ok"] = [as_node(d) for d in read_snapshot("verified", ctx["snap_dir"])[1]]
+        except FileNotFoundError:
+            ctx["google_ok"] = []
+    google_ok = ctx["google_ok"]
+
+    tcp_ok_nodes = [x for lst in by_type.values() for x in lst]
+    avg_ms = avg_delay([n.get("delay",0) for n in tcp_ok_nodes])
+    export_subscriptions(tcp_ok_nodes, google_ok if STRICT_CN_GOOGLE else None)
+    exported = [export_proto(proto, by_type.get(proto, [])) for proto in EXPORT_PROTOS]
+
     summary = {
         "updated": now_str_beijing(),
-        "collected": collected,
+        "collected": ctx.get("collected", 0),
         "tcp_ok": len(tcp_ok_nodes),
         "google_ok": len(google_ok),
         "avg_delay": avg_ms
     }
-    html = build_index_html(summary, per_proto_all_cards, per_proto_batches, per_proto_singles, per_proto_top5)
-    write_text(os.path.join(DOCS_DIR, "index.html"), html)
+    ctx["summary"] = summary
+    ctx["cards"] = page_cards(exported)
+    write_snapshot("exported", exported, {"summary": summary}, ctx["snap_dir"])
+    print(f"完成：初步收集 {summary['collected']}，TCP可用 {len(tcp_ok_nodes)}，Google可用 {len(google_ok)}，平均延迟 {avg_ms}ms")
+
+def stage_page(ctx: Dict):
+    """由 exported 快照渲染 index.html"""
+    if "cards" not in ctx:
+        meta, rows = read_snapshot("exported", ctx["snap_dir"])
+        ctx["summary"] = meta.get("summary", {})
+        ctx["cards"] = page_cards(rows)
+    summary = ctx["summary"]
+    with STATS.stage("html"):
+        html = build_index_html(summary, *ctx["cards"])
+        write_text(os.path.join(DOCS_DIR, "index.html"), html)
+    STATS.add("html", bytes=len(html))
+    RUN_REPORT["summary"] = summary
+
+STAGE_FUNCS = {"fetch": stage_fetch, "probe": stage_probe, "verify": stage_verify,
+               "export": stage_export, "page": stage_page}
+
+def main(stages=PIPELINE_STAGES, snap_dir: str = None, shards: int = PROBE_SHARDS,
+         shard: Tuple[int, int] = None, merge: List[str] = None, backend: str = None):
+    """
+    按 PIPELINE_STAGES 顺序运行所选阶段；未选的上游阶段从快照读取。
+    默认全部运行（fetch 与 probe 合并为流式流水线），行为与分阶段前一致。
+    shards / shard / merge 见 stage_probe（分片测速）；backend 为 TCP 测速后端（见 SCAN_BACKENDS），默认 SCAN_BACKEND。
+    """
+    stages = [st for st in PIPELINE_STAGES if st in stages]
+    loop = new_event_loop()
+    asyncio.set_event_loop(loop)
+    ctx = {"loop": loop, "snap_dir": snap_dir or SNAP_DIR, "shards": shards, "shard": shard, "merge": merge,
+           "shard_dir": os.path.join(snap_dir or SNAP_DIR, "shards"), "backend": backend or SCAN_BACKEND}
+    # 分片测速需要完整的候选列表再切分，不与抓取融合
+    ctx["fused_fetch"] = "fetch" in stages and "probe" in stages and shards <= 1 and not shard and not merge
+    RUN_REPORT["stages"] = stages
+    for st in stages:
+        if st == "fetch" and ctx["fused_fetch"]:
+            continue
+        STAGE_FUNCS[st](ctx)
+        if ctx.get("halt"):
+            break
+
+    if STATS_ENABLED:
+        write_run_report()
+        # seconds 为各次调用耗时之和（并发阶段可超过跨度）；wall 为首次开始到最后结束，首尾都出现的阶段会很大
+        print("[Stats] " + "，".join(f"{k} {v['seconds']:.1f}s（跨度 {v['wall']:.1f}s）" for k, v in
+                                     sorted(STATS.snapshot()["stages"].items(), key=lambda kv: -kv[1]["seconds"])))
+    if "export" in stages and not ctx.get("halt"):
+        print("已生成：主订阅/子订阅、各协议整包 + 批次 YAML、纯链接列表、双二维码、单节点二维码（紫）、Top-5 紧凑列表（黄）、统计页。")
+
+# ===================== 守护模式（常驻内存：滚动复测 + 源定时刷新 + 增量导出） =====================
+class LiveState:
+    """
+    守护模式的内存状态（键同 node_key）：
+      nodes  候选与已展开的协议节点；alive 最近一次探测存活的协议节点
+      meta   [连续失败, 状态翻转热度, 最近延迟样本]；due 为 (到期时间, 序号, 键) 最小堆
+    复测间隔按名次线性放大（第 1 名 DAEMON_PROBE_TOP → 末位 DAEMON_PROBE_TAIL），
+    存活/失效来回翻转的节点按热度缩短间隔；失败节点指数退避，连续失败过多则移出。
+    """
+
+    def __init__(self, health: HealthDB = None, backend: str = None):
+        self.nodes: Dict = {}
+        self.alive: Dict = {}
+        self.meta: Dict = {}
+        self.due: List = []
+        self._seq = itertools.count()
+        self.seen: set = set()            # parse_source 的去重集合，移出节点时同步删除
+        self.rank_of: Dict = {}           # 键 → 协议内名次（每次检查排行时刷新）
+        self.app_checked: set = set()
+        self.health = health
+        self.backend = backend
+        self.sources = {u: {"next": 0.0, "interval": DAEMON_SOURCE_INTERVAL, "digest": ""} for u in SOURCES}
+        self.published: Dict[str, List] = {}   # 协议 → 上次导出时的有序键列表
+        self.exported: Dict[str, Dict] = {}    # 协议 → export_proto 结果（页面卡片）
+        self.google_ok: List[Dict] = []
+        self.index: Optional[SubIndex] = None  # 订阅服务读取的当前索引（每次导出时整体替换）
+        self.last_full = 0.0                   # 上次全量导出时间
+        self.probes = 0
+        self.evicted = 0
+
+    @staticmethod
+    def key(n: Dict):
+        # 与 parse_source 写入 seen 的键一致：YAML 节点的端口可能是字符串
+        return node_key(n["type"], n["server"], safe_int(n["port"]))
+
+    def add(self, nodes: List[Dict], when: float) -> int:
+        added = 0
+        for n in nodes:
+            k = self.key(n)
+            if k in self.nodes:
+                continue
+            self.nodes[k] = n
+            self.meta[k] = [0, 0.0, []]
+            heapq.heappush(self.due, (when, next(self._seq), k))
+            added += 1
+        return added
+
+    def backlog(self, now: float) -> int:
+        return sum(1 for t, _, _ in self.due if t <= now)
+
+    def interval(self, k) -> float:
+        fails, heat, _ = self.meta[k]
+        if fails:
+            return min(DAEMON_PROBE_MAX, DAEMON_PROBE_TAIL * 2 ** (fails - 1))
+        if self.nodes[k].get("type") == "endpoint":
+            return DAEMON_PROBE_MAX
+        r = self.rank_of.get(k)
+        frac = 1.0 if r is None else r / max(1, KEEP_TOP_PER_TYPE - 1)
+        iv = DAEMON_PROBE_TOP + (DAEMON_PROBE_TAIL - DAEMON_PROBE_TOP) * frac
+        return max(DAEMON_PROBE_TOP, iv / (1.0 + heat)) * random.uniform(0.9, 1.1)
+
+    def _observe(self, k, n: Dict, d: Optional[float]):
+        """记录一次协议节点探测结果：延迟取最近几次样本的中位数"""
+        m = self.meta[k]
+        was = k in self.alive
+        first = not m[2] and not m[0]
+        if d is not None:
+            m[0] = 0
+            m[2] = (m[2] + [d])[-HEALTH_KEEP_DELAYS:]
+            n["delay"] = round(quantile(sorted(m[2]), 0.5), 1)
+            self.alive[k] = n
+        else:
+            m[0] += 1
+            self.alive.pop(k, None)
+        if not first:
+            m[1] = m[1] + 1.0 if was != (d is not None) else m[1] * 0.8
+
+    async def probe(self, k, sem: AdaptiveLimiter):
+        n = self.nodes.get(k)
+        if n is None:
+            return
+        self.probes += 1
+        alive, _ = await probe_node(n, sem, backend=self.backend)
+        if k not in self.nodes:                  # 探测期间已被移出
+            return
+        now = time.time()
+        if n.get("type") == "endpoint":
+            self.meta[k][0] = 0 if alive else self.meta[k][0] + 1
+            for x in alive:
+                kk = self.key(x)
+                if kk not in self.nodes:
+                    self.add([x], now + DAEMON_PROBE_TOP)
+                self._observe(kk, self.nodes[kk], x["delay"])
+        else:
+            self._observe(k, n, n["delay"] if alive else None)
+        if self.health is not None:
+            self.health.record(n, alive[0]["delay"] if alive else None)
+        if self.meta[k][0] >= DAEMON_EVICT_FAILS:
+            self.evict(k)
+        else:
+            heapq.heappush(self.due, (now + self.interval(k), next(self._seq), k))
+
+    def evict(self, k):
+        n = self.nodes.pop(k)
+        self.meta.pop(k, None)
+        self.alive.pop(k, None)
+        self.rank_of.pop(k, None)
+        self.seen.discard(k)
+        if n.get("type") == "endpoint":
+            for kk in node_keys(n.get("sniff") or IPPORT_PROTOS, n["server"], n["port"]):
+                if kk not in self.nodes:
+                    self.seen.discard(kk)
+            if n.get("_cdn"):                 # 折叠代表被移出后，同网段同端口的下一个候选可以补上
+                self.seen.discard(cdn_group_key(cdn_index().lookup(pack_ipv4(n["server"])), n["port"]))
+        self.evicted += 1
+
+    async def refresh_sources(self, session, fetch_pool, parse_pool):
+        """到期的源重新抓取（条件 GET）；内容未变则该源刷新间隔翻倍，变化则恢复基础间隔并加入新节点"""
+        loop = asyncio.get_running_loop()
+        now = time.time()
+
+        async def one(url, st):
+            text, _ = await loop.run_in_executor(fetch_pool, fetch_source, session, url,
+                                                 time.monotonic() + FETCH_TIMEOUT * 2)
+            digest = hashlib.blake2b(text.encode("utf-8", "ignore"), digest_size=16).hexdigest() if text else ""
+            if not text or digest == st["digest"]:
+                st["interval"] = min(DAEMON_SOURCE_MAX, st["interval"] * 2)
+            else:
+                st["interval"] = DAEMON_SOURCE_INTERVAL
+                st["digest"] = digest
+                new = await loop.run_in_executor(parse_pool, parse_source, url, text, self.seen)
+                added = self.add(new, time.time())
+                print(f"[Daemon] 源更新 +{added} ← {url}")
+            st["next"] = time.time() + st["interval"] * random.uniform(0.9, 1.1)
+
+        await asyncio.gather(*(one(u, st) for u, st in self.sources.items() if st["next"] <= now))
+
+    def ranked(self) -> Dict[str, List[Dict]]:
+        """当前存活节点的每协议 Top-K（按 rank_value），同时刷新名次"""
+        groups: Dict[str, List] = {}
+        for k, n in self.alive.items():
+            groups.setdefault((n.get("type") or "").lower(), []).append(n)
+        by_type = {t: heapq.nsmallest(KEEP_TOP_PER_TYPE, lst, key=rank_value) for t, lst in groups.items()}
+        self.rank_of = {self.key(n): i for lst in by_type.values() for i, n in enumerate(lst)}
+        return by_type
+
+    def changed_protos(self, by_type: Dict[str, List[Dict]]) -> List[str]:
+        """
+        成员变化达到 DAEMON_REPUBLISH_DELTA，或前 TOPN_YELLOW_BUNDLE 名（单节点 / Top-5 二维码）有进出的协议。
+        前几名内部的顺序抖动不触发重写，由 DAEMON_REPUBLISH_MAX 的定期全量重写刷新。
+        """
+        out = []
+        for proto in EXPORT_PROTOS:
+            new = [self.key(n) for n in by_type.get(proto, [])]
+            old = self.published.get(proto)
+            if old is None:
+                out.append(proto)
+                continue
+            a, b = set(old), set(new)
+            dist = 1.0 - len(a & b) / len(a | b) if (a | b) else 0.0
+            if dist >= DAEMON_REPUBLISH_DELTA or set(old[:TOPN_YELLOW_BUNDLE]) != set(new[:TOPN_YELLOW_BUNDLE]):
+                out.append(proto)
+        return out
 
-    print(f"完成：初步收集 {collected}，TCP可用 {len(tcp_ok_nodes)}，Google可用 {len(google_ok)}，平均延迟 {avg_ms}ms")
-    print("已生成：主订阅/子订阅、各协议整包 + 批次 YAML、纯链接列表、双二维码、单节点二维码（紫）、Top-5 紧凑列表（黄）、统计页。")
+    async def publish(self, force: bool = False) -> List[str]:
+        """排行实质变化时增量导出：只重写变化的协议，主订阅 / 统计页 / 快照随之更新"""
+        loop = asyncio.get_running_loop()
+        by_type = self.ranked()
+        changed = list(EXPORT_PROTOS) if force else self.changed_protos(by_type)
+        if not changed:
+            return []
+        if APP_PROBE:
+            todo = [n for t in APP_PROBE_TYPES if t in changed for n in by_type.get(t, [])
+                    if self.key(n) not in self.app_checked]
+            sem = asyncio.Semaphore(CONCURRENCY)
+            async def one(n):
+                async with sem:
+                    await app_probe(n)
+                self.app_checked.add(self.key(n))
+            await asyncio.gather(*(one(n) for n in todo))
+            if todo:
+                by_type = self.ranked()
+        if STRICT_CN_GOOGLE and (force or {"socks4", "socks5", "http"} & set(changed)):
+            cand = by_type.get("socks4", []) + by_type.get("socks5", []) + by_type.get("http", [])
+            self.google_ok = await verify_all(cand)
+        # 写盘在线程池中进行，而探测仍在事件循环上改写节点 / 健康库：交出去的一律是此刻的副本
+        full = len(changed) == len(EXPORT_PROTOS)
+        by_type = {t: [n.copy() for n in lst] for t, lst in by_type.items()}
+        google_ok = [n.copy() for n in self.google_ok]
+        health = self.health.snapshot() if self.health is not None and full else None
+        await loop.run_in_executor(None, self._write, by_type, changed, google_ok, health,
+                                   len(self.nodes), self.report())
+        for proto in changed:
+            self.published[proto] = [self.key(n) for n in by_type.get(proto, [])]
+        if full:
+            self.last_full = time.time()
+        return changed
+
+    def _write(self, by_type: Dict[str, List[Dict]], changed: List[str], google_ok: List[Dict],
+               health: Optional[Tuple[Dict, int]], collected: int, report: Dict):
+        """在线程池中运行：只读传入的副本，不触碰 self.nodes / self.health.db 等事件循环上的状态"""
+        tcp_ok_nodes = [x for lst in by_type.values() for x in lst]
+        avg_ms = avg_delay([n.get("delay", 0) for n in tcp_ok_nodes])
+        self.index = SubIndex(by_type, google_ok)
+        export_subscriptions(tcp_ok_nodes, google_ok if STRICT_CN_GOOGLE else None)
+        for proto in changed:
+            self.exported[proto] = export_proto(proto, by_type.get(proto, []))
+        exported = [self.exported[p] for p in EXPORT_PROTOS if p in self.exported]
+        summary = {
+            "updated": now_str_beijing(),
+            "collected": collected,
+            "tcp_ok": len(tcp_ok_nodes),
+            "google_ok": len(google_ok),
+            "avg_delay": avg_ms
+        }
+        with STATS.stage("html"):
+            write_text(os.path.join(DOCS_DIR, "index.html"), build_index_html(summary, *page_cards(exported)))
+        write_snapshot("probed", tcp_ok_nodes, {"collected": collected, "updated": summary["updated"]})
+        write_snapshot("exported", exported, {"summary": summary})
+        RUN_REPORT["summary"] = summary
+        RUN_REPORT["daemon"] = report
+        if health is not None:
+            self.health.save(health)
+        if STATS_ENABLED:
+            write_run_report()
+        print(f"[Daemon] 导出 {','.join(changed)}：TCP可用 {len(tcp_ok_nodes)}，Google可用 {len(google_ok)}，"
+              f"平均延迟 {avg_ms}ms")
+
+    def report(self) -> Dict:
+        return {"nodes": len(self.nodes), "alive": len(self.alive), "probes": self.probes,
+                "evicted": self.evicted, "pending": len(self.due),
+                "sources": {u: round(st["interval"]) for u, st in self.sources.items()}}
+
+async def run_daemon(duration: float = 0.0, serve: str = None, backend: str = None):
+    """
+    常驻运行：源按各自间隔刷新，节点按名次 / 翻转热度滚动复测，排行实质变化时增量导出。
+    duration > 0 时运行该秒数后退出（测试用）；SIGINT / SIGTERM 时完成当前导出后退出。
+    给定 serve 地址时同时启动订阅服务，直接读取内存中的最新索引。
+    backend 为 TCP 测速后端（见 SCAN_BACKENDS），默认 SCAN_BACKEND。
+    """
+    loop = asyncio.get_running_loop()
+    state = LiveState(HealthDB() if HEALTH_ENABLED else None, backend)
+    httpd = start_sub_server(serve, lambda: state.index)[0] if serve else None
+    sem = AdaptiveLimiter()
+    session = make_session()
+    fetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+    parse_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    stop = asyncio.Event()
+    for sig in ("SIGINT", "SIGTERM"):
+        with contextlib.suppress(NotImplementedError, AttributeError, RuntimeError):
+            loop.add_signal_handler(getattr(signal, sig), stop.set)
+    end = time.monotonic() + duration if duration > 0 else None
+    tasks: set = set()
+    refresher = publisher = None
+    last_check = time.monotonic()
+    print("[Daemon] 启动：源定时刷新 + 滚动复测 + 增量导出")
+
+    def done(t):
+        tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            print(f"[Daemon] 任务异常：{t.exception()!r}")
+            traceback.print_exception(t.exception())
+
+    def spawn(coro):
+        t = asyncio.ensure_future(coro)
+        tasks.add(t)
+        t.add_done_callback(done)
+        return t
+
+    try:
+        while not stop.is_set() and (end is None or time.monotonic() < end):
+            now = time.time()
+            if (refresher is None or refresher.done()) and any(st["next"] <= now for st in state.sources.values()):
+                refresher = spawn(state.refresh_sources(session, fetch_pool, parse_pool))
+            while state.due and state.due[0][0] <= now and len(tasks) < DAEMON_INFLIGHT:
+                _, _, k = heapq.heappop(state.due)
+                if k in state.nodes:
+                    spawn(state.probe(k, sem))
+            if (publisher is None or publisher.done()) and time.monotonic() - last_check >= DAEMON_PUBLISH_CHECK:
+                last_check = time.monotonic()
+                stale = now - state.last_full >= DAEMON_REPUBLISH_MAX
+                if state.alive and (not state.backlog(now) or stale):
+                    publisher = spawn(state.publish(force=stale and bool(state.published)))
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop.wait(), timeout=1.0)
+        if publisher is not None and not publisher.done():
+            await publisher
+    finally:
+        for t in list(tasks):
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        fetch_pool.shutdown(wait=False, cancel_futures=True)
+        parse_pool.shutdown(wait=False)
+        shutdown_parse_pool()
+        if httpd is not None:
+            httpd.shutdown()
+        if state.health is not None:
+            state.health.save()
+        RUN_REPORT["daemon"] = state.report()
+        RUN_REPORT["concurrency"] = sem.report()
+        print(f"[Daemon] 退出：{state.report()}")
+
+# ===================== 订阅 HTTP 服务（内存索引 + 过滤 + ETag / gzip 缓存） =====================
+class SubIndex:
+    """
+    只读的订阅索引：每协议按排行有序的节点及其预先展开的 Clash dict、延迟、是否通过 Google 验证。
+    更新时整体替换（version 随之变化），请求线程无需加锁。
+    """
+
+    def __init__(self, by_type: Dict[str, List[Dict]], verified: List[Dict] = (), version: str = ""):
+        ok = {node_key(n["type"], n["server"], n["port"]) for n in verified}
+        self.by_type = {t: list(lst) for t, lst in by_type.items()}
+        self.clash = {t: to_clash_proxies(lst) for t, lst in self.by_type.items()}
+        self.delay = {t: [n.get("delay", 9e9) for n in lst] for t, lst in self.by_type.items()}
+        self.verified = {t: [node_key(n["type"], n["server"], n["port"]) in ok for n in lst]
+                         for t, lst in self.by_type.items()}
+        # 版本覆盖完整 Clash 条目与验证标记：任何影响输出的变化（含仅重跑 verify）都会让 LRU / ETag 失效
+        self.version = version or hashlib.blake2b(
+            json.dumps([[t, self.clash[t], self.verified[t]] for t in self.clash],
+                       sort_keys=True, default=str).encode(), digest_size=6).hexdigest()
+        self.links: Dict[Tuple[str, int], str] = {}
+
+    @classmethod
+    def from_snapshots(cls, snap_dir: str = None) -> "SubIndex":
+        meta, nodes = read_snapshot("probed", snap_dir)
+        try:
+            verified = read_snapshot("verified", snap_dir)[1]
+        except FileNotFoundError:
+            verified = []
+        return cls(_group_by_type([as_node(d) for d in nodes]), verified)
+
+    def select(self, types, top: int, max_delay: float, verified: bool) -> List[Tuple[str, int]]:
+        out = []
+        for t in types:
+            taken = 0
+            for i, d in enumerate(self.delay.get(t, ())):
+                if top and taken >= top:
+                    break
+                if d > max_delay or (verified and not self.verified[t][i]):
+                    continue
+                out.append((t, i))
+                taken += 1
+        return out
+
+    def link(self, t: str, i: int) -> str:
+        lk = self.links.get((t, i))
+        if lk is None:
+            lk = self.links[(t, i)] = to_proto_link(self.by_type[t][i])
+        return lk
+
+    def summary(self) -> Dict:
+        return {"version": self.version, "types": {t: len(lst) for t, lst in self.by_type.items()},
+                "verified": sum(sum(v) for v in self.verified.values())}
+
+class SnapshotIndex:
+    """独立服务模式的索引来源：probed / verified 快照更新（mtime 变化）后自动重建，至多每秒检查一次"""
+
+    def __init__(self, snap_dir: str = None):
+        self.snap_dir = snap_dir
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = 0.0
+        self.index: Optional[SubIndex] = None
+
+    def __call__(self) -> Optional[SubIndex]:
+        now = time.monotonic()
+        if now - self._checked < 1.0 and self.index is not None:
+            return self.index
+        with self._lock:
+            self._checked = now
+            try:
+                mtime = tuple(os.path.getmtime(_snap_path(nm, self.snap_dir)) if os.path.exists(_snap_path(nm, self.snap_dir))
+                              else 0.0 for nm in ("probed", "verified"))
+            except OSError:
+                return self.index
+            if mtime != self._mtime:
+                try:
+                    self.index = SubIndex.from_snapshots(self.snap_dir)
+                    self._mtime = mtime
+                    print(f"[Serve] 索引已载入 {self.index.summary()}")
+                except (FileNotFoundError, ValueError) as e:
+                    print(f"[Serve] 索引载入失败：{e}")
+        return self.index
+
+def accepts_gzip(header: str) -> bool:
+    """按 q 值解析 Accept-Encoding：gzip（或 x-gzip）q>0 即接受；未列出时看 *；gzip;q=0 视为拒绝"""
+    star = None
+    for part in (header or "").split(","):
+        coding, *params = [x.strip() for x in part.split(";")]
+        q = 1.0
+        for prm in params:
+            name, _, val = prm.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(val)
+                except ValueError:
+                    q = 0.0
+        coding = coding.lower()
+        if coding in ("gzip", "x-gzip"):
+            return q > 0
+        if coding == "*":
+            star = q > 0
+    return bool(star)
+
+class SubServer:
+    """
+    按查询参数切片订阅：
+      /sub（Base64 Clash YAML）、/proxy.yaml、/links（纯链接，b64=1 时 Base64）、/nodes.json、/healthz
+      type=ss,vmess  top=每协议前 N  max_delay=毫秒  verified=1（仅通过 Google 严格验证）  limit=总数上限
+    渲染结果按 (索引版本, 路由, 规范化参数) 缓存在有界 LRU 中，附 ETag 与 gzip 版本；支持 If-None-Match。
+    """
+    ROUTES = {"/sub": "sub", "/proxy.yaml": "yaml", "/clash.yaml": "yaml", "/links": "links", "/nodes.json": "json"}
+    TYPES = {"sub": "text/plain; charset=utf-8", "yaml": "text/yaml; charset=utf-8",
+             "links": "text/plain; charset=utf-8", "json": "application/json"}
+
+    def __init__(self, index_source):
+        self.index_source = index_source
+        self._cache: "collections.OrderedDict" = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _params(query: str) -> Tuple:
+        q = {k: v[-1] for k, v in parse_qs(query).items()}
+        types = tuple(sorted({t.strip().lower() for t in q.get("type", "").split(",") if t.strip()})) \
+            or EXPORT_PROTOS
+        top = int(q.get("top", 0))
+        max_delay = float(q.get("max_delay", 9e9))
+        verified = q.get("verified", "") in ("1", "true", "yes")
+        limit = int(q.get("limit", 0))
+        b64 = q.get("b64", "") in ("1", "true", "yes")
+        if top < 0 or limit < 0 or max_delay <= 0:
+            raise ValueError("参数越界")
+        return types, top, max_delay, verified, limit, b64
+
+    def _render(self, idx: SubIndex, fmt: str, params: Tuple) -> bytes:
+        types, top, max_delay, verified, limit, b64 = params
+        sel = idx.select(types, top, max_delay, verified)
+        if limit:
+            sel = sel[:limit]
+        if fmt in ("sub", "yaml"):
+            body = yaml.safe_dump({"proxies": [idx.clash[t][i] for t, i in sel]},
+                                  allow_unicode=True, sort_keys=False).encode("utf-8")
+            return base64.b64encode(body) if fmt == "sub" else body
+        if fmt == "links":
+            body = "\n".join(lk for lk in (idx.link(t, i) for t, i in sel) if lk).encode("utf-8")
+            return base64.b64encode(body) if b64 else body
+        return json.dumps([idx.clash[t][i] for t, i in sel], ensure_ascii=False, default=str).encode("utf-8")
+
+    def _entry(self, idx: SubIndex, fmt: str, params: Tuple) -> Tuple[bytes, Optional[bytes], str]:
+        key = (idx.version, fmt, params)
+        with self._lock:
+            hit = self._cache.get(key)
+            if hit is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return hit
+        body = self._render(idx, fmt, params)
+        gz = gzip.compress(body, compresslevel=6, mtime=0) if len(body) >= SERVE_GZIP_MIN else None
+        etag = '"%s-%s"' % (idx.version, hashlib.blake2b(body, digest_size=8).hexdigest())
+        entry = (body, gz, etag)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = entry
+            while len(self._cache) > SERVE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return entry
+
+    def respond(self, target: str, headers) -> Tuple[int, Dict[str, str], bytes]:
+        """返回 (状态码, 响应头, 响应体)；与具体 HTTP 框架无关"""
+        parts = urlsplit(target)
+        if parts.path == "/healthz":
+            idx = self.index_source()
+            body = json.dumps({"ok": idx is not None, "index": idx.summary() if idx else None,
+                               "cache": {"size": len(self._cache), "hits": self.hits, "misses": self.misses}},
+                              ensure_ascii=False).encode("utf-8")
+            return 200, {"Content-Type": "application/json", "Cache-Control": "no-store"}, body
+        fmt = self.ROUTES.get(parts.path)
+        if fmt is None:
+            return 404, {"Content-Type": "text/plain; charset=utf-8"}, b"not found\n"
+        try:
+            params = self._params(parts.query)
+        except ValueError as e:
+            return 400, {"Content-Type": "text/plain; charset=utf-8"}, f"bad query: {e}\n".encode("utf-8")
+        idx = self.index_source()
+        if idx is None:
+            return 503, {"Content-Type": "text/plain; charset=utf-8", "Retry-After": "30"}, b"index not ready\n"
+        body, gz, etag = self._entry(idx, fmt, params)
+        use_gz = gz is not None and accepts_gzip(headers.get("Accept-Encoding", ""))
+        gz_etag = etag[:-1] + '-gz"'             # 不同编码是不同表示，强校验器必须不同
+        out = {"ETag": gz_etag if use_gz else etag, "Cache-Control": f"max-age={SERVE_MAX_AGE}",
+               "Vary": "Accept-Encoding", "Content-Type": self.TYPES[fmt]}
+        inm = headers.get("If-None-Match", "")
+        tags = [t.strip().removeprefix("W/") for t in inm.split(",")]
+        if inm and (inm.strip() == "*" or etag in tags or gz_etag in tags):
+            return 304, out, b""
+        if use_gz:
+            out["Content-Encoding"] = "gzip"
+            return 200, out, gz
+        return 200, out, body
+
+def start_sub_server(addr: str, index_source) -> Tuple[ThreadingHTTPServer, SubServer]:
+    """在后台线程启动订阅服务；addr 形如 "127.0.0.1:8080" 或 ":8080" """
+    host, _, port = addr.rpartition(":")
+    app = SubServer(index_source)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, head_only: bool):
+            status, hdrs, body = app.respond(self.path, self.headers)
+            self.send_response(status)
+            for k, v in hdrs.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if body and not head_only:
+                self.wfile.write(body)
+
+        def do_GET(self):
+            self._send(False)
+
+        def do_HEAD(self):
+            self._send(True)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host or "0.0.0.0", int(port)), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="sub-server", daemon=True).start()
+    print(f"[Serve] http://{host or '0.0.0.0'}:{httpd.server_address[1]}/sub  （/proxy.yaml /links /nodes.json /healthz）")
+    return httpd, app
+
+def parse_args(argv=None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="抓取订阅源、测速并生成 docs/ 下的订阅、二维码与统计页")
+    ap.add_argument("--stages", default=",".join(PIPELINE_STAGES), metavar="S1,S2",
+                    help=f"只运行所选阶段（{'/'.join(PIPELINE_STAGES)}），未选的上游阶段读取快照；默认全部")
+    ap.add_argument("--snap-dir", default=SNAP_DIR, metavar="DIR", help="中间快照目录（默认 .cache/snap）")
+    ap.add_argument("--shards", type=int, default=PROBE_SHARDS, metavar="N",
+                    help="本机分片测速：按 (server, port) 哈希切成 N 片，各用一个进程 / 事件循环，结果合并为同一排行")
+    ap.add_argument("--shard", type=parse_shard, default=None, metavar="I/N",
+                    help="多机分片：只测第 I 片（共 N 片），写出 <snap-dir>/shards/probed-I-of-N.jsonl 后停止")
+    ap.add_argument("--merge", nargs="+", default=None, metavar="PATH",
+                    help="合并分片结果文件（或包含它们的目录）代替 probe 阶段的测速，继续采样 / 应用层测速与后续阶段")
+    ap.add_argument("--parse-workers", type=int, default=PARSE_WORKERS, metavar="N",
+                    help=f"解析进程数：1=串行，0=按 CPU 核数（默认 {PARSE_WORKERS}，可由环境变量 PARSE_WORKERS 设置）")
+    ap.add_argument("--backend", choices=sorted(SCAN_BACKENDS), default=SCAN_BACKEND,
+                    help=f"TCP 测速建连后端（默认 {SCAN_BACKEND}）：stream=open_connection，sock=loop.sock_connect，raw=connect_ex + add_writer")
+    ap.add_argument("--daemon", nargs="?", type=float, const=0.0, default=None, metavar="SECONDS",
+                    help="守护模式：常驻内存滚动复测、源定时刷新、排行变化时增量导出（给定秒数则运行该时长后退出）")
+    ap.add_argument("--serve", nargs="?", const=SERVE_ADDR, default=None, metavar="[HOST]:PORT",
+                    help=f"订阅 HTTP 服务（默认 {SERVE_ADDR}）；与 --daemon 同用时读内存索引，否则读 probed 快照并随其更新")
+    ap.add_argument("--profile", nargs="?", const=os.path.join(CACHE_DIR, "profile"), default=None, metavar="DIR",
+                    help="按阶段 cProfile，输出 <阶段>.pstats 与合并热点 summary.txt（默认目录 .cache/profile）")
+    ap.add_argument("--profile-top", type=int, default=PROFILE_TOP, metavar="N", help="合并热点显示前 N 个函数")
+    ap.add_argument("--profile-tasks", action="store_true", help="同时记录 asyncio 任务级耗时（wall / 事件循环内执行）")
+    args = ap.parse_args(argv)
+    args.stages = [st.strip() for st in args.stages.split(",") if st.strip()]
+    unknown = [st for st in args.stages if st not in PIPELINE_STAGES]
+    if unknown or not args.stages:
+        ap.error(f"未知阶段 {unknown}，可选：{','.join(PIPELINE_STAGES)}")
+    if args.shards < 1:
+        ap.error("--shards 至少为 1")
+    if args.parse_workers < 0:
+        ap.error("--parse-workers 不能为负数")
+    if (args.shard or args.merge) and "probe" not in args.stages:
+        ap.error("--shard / --merge 作用于 probe 阶段，--stages 需包含 probe")
+    return args
 
 if __name__ == "__main__":
+    args = parse_args()
+    PARSE_WORKERS = args.parse_workers
+    profiler = None
+    if args.profile:
+        profiler = StageProfiler(args.profile, tasks=args.profile_tasks)
+        profiler.install()
     try:
-        main()
+        if args.daemon is not None:
+            loop = new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(run_daemon(args.daemon, args.serve, args.backend))
+        elif args.serve:
+            httpd, _ = start_sub_server(args.serve, SnapshotIndex(args.snap_dir))
+            with contextlib.suppress(KeyboardInterrupt):
+                threading.Event().wait()
+        else:
+            main(args.stages, args.snap_dir, args.shards, args.shard, args.merge, args.backend)
     except Exception as e:
         print("运行异常：", e)
         traceback.print_exc()
+        if STATS_ENABLED:
+            RUN_REPORT["error"] = f"{type(e).__name__}: {e}"
+            write_run_report()
         sys.exit(1)
+    finally:
+        if profiler is not None:
+            print(profiler.dump(args.profile_top))
+            print(f"[Profile] pstats 与摘要已写入 {args.profile}/")